@@ -10,6 +10,7 @@ from sblearn import entities
 from sblearn import field
 from sblearn import states
 from sblearn import substances
+from sblearn import training
 from sblearn import visualization
 from sblearn import modelling
 
@@ -17,8 +18,9 @@ from sblearn import modelling
 # Create deity
 class Priapus(field.Demiurge):  # Create deity
     def __init__(self):
-        self.public_memory = brain.LearningMemory(self)
+        self.public_memory = brain.ColumnarLearningMemory(self)
         self.public_decision_model = SGDClassifier(warm_start=True)
+        self.trainer = training.ModelTrainer(self)
 
     def handle_creation(self, creation, refuse):
         if isinstance(creation, entities.Creature):
@@ -27,6 +29,9 @@ class Priapus(field.Demiurge):  # Create deity
             creation.memory_type = "public"
             creation.model_type = "public"
             creation.memory_batch_size = 20
+            creation.trainer = self.trainer
+            creation.training_mode = "partial_fit"
+            creation.training_classes = [0., 1.]
 
             if creation.sex:
                 def difference_in_num_substance(entity):
@@ -53,15 +58,15 @@ class Priapus(field.Demiurge):  # Create deity
 
                 creation.set_memorize_task(actions.GoMating, features,
                                            {"func": lambda creation: creation.chosen_action.results["accomplished"],
-                                            "kwargs": {"creation": creation}})
+                                            "kwargs": {"creation": creation}},
+                                           cache_features=True)
+                creation.decision_task = actions.GoMating
 
             def plan(creature):
                 if creature.sex:
                     try:
                         # raise NotFittedError
-                        current_features = creature.get_features(actions.GoMating)
-                        current_features = np.asarray(current_features).reshape(1, -1)
-                        if creature.public_decision_model.predict(current_features):
+                        if creature.decide():
                             go_mating = actions.GoMating(creature)
                             creature.queue_action(go_mating)
                             return
@@ -3,8 +3,10 @@
 import cProfile
 import math
 import random
+import unittest
 
 import entities
+import pathfinding
 import states
 
 
@@ -136,6 +138,8 @@ class MovementToEntity(MovementXY):
 
         self._target_entity = None
 
+        self.planner = pathfinding.IncrementalPlanner()
+
     def get_objective(self):
         out = {"target_entity": self._target_entity}
 
@@ -187,20 +191,17 @@ class MovementToEntity(MovementXY):
             distance = abs(self.subject.x - self._target_entity.x) + abs(self.subject.y - self._target_entity.y)
             self.accomplished = distance < 2
 
+    def initialize_path(self):
+
+        self.path = self.planner.plan(self.subject.board, self.subject.x, self.subject.y, self._target_x,
+                                      self._target_y, self.path)
+
     def set_target_coordinates(self):
         if self._target_entity.passable:
             self._target_x = self._target_entity.x
             self._target_y = self._target_entity.y
         else:
-            cells_near = []
-            if self.subject.board.cell_passable(self._target_entity.x, self._target_entity.y + 1):
-                cells_near.append((self._target_entity.x, self._target_entity.y + 1))
-            if self.subject.board.cell_passable(self._target_entity.x, self._target_entity.y - 1):
-                cells_near.append((self._target_entity.x, self._target_entity.y - 1))
-            if self.subject.board.cell_passable(self._target_entity.x + 1, self._target_entity.y):
-                cells_near.append((self._target_entity.x + 1, self._target_entity.y))
-            if self.subject.board.cell_passable(self._target_entity.x - 1, self._target_entity.y):
-                cells_near.append((self._target_entity.x - 1, self._target_entity.y))
+            cells_near = self.subject.board.free_cells_around(self._target_entity.x, self._target_entity.y)
             if len(cells_near) == 0:
                 return
 
@@ -264,8 +265,24 @@ class SearchSubstance(Action):
         return out
 
     def search(self):
+        board = self.subject.board
+
+        coordinates = board.distance_field(self._target_substance_type).nearest_source(self.subject.x, self.subject.y)
+        if coordinates is None:
+            return
+
+        # The field is computed at the start of the epoch, the substance may be gone by now
+        if board.cell_passable(*coordinates):
+            for element in board.get_cell(*coordinates):
+                if element.contains(self._target_substance_type):
+                    self._substance_x, self._substance_y = coordinates
+                    return
+
+        self.flood_search()
+
+    def flood_search(self):
         current_wave = [(self.subject.x, self.subject.y)]
-        checked = {self.subject.x, self.subject.y}
+        checked = {(self.subject.x, self.subject.y)}
 
         while current_wave:
             next_wave = []
@@ -297,6 +314,7 @@ class SearchMatingPartner(Action):
         super(SearchMatingPartner, self).__init__(subject)
 
         self.instant = True
+        self.initial_radius = 8
 
         self._partner = None
 
@@ -324,8 +342,72 @@ class SearchMatingPartner(Action):
         return out
 
     def search(self):
+        if not self.subject.mating_ready():
+            return
+
+        board = self.subject.board
+        index = board.partner_index(not self.subject.sex)
+        radius = self.initial_radius
+
+        # Path distance is never shorter than Manhattan distance, so a partner
+        # reachable within radius steps is among the candidates of that radius
+        while len(index) > 0:
+            candidates = index.within(self.subject.x, self.subject.y, radius)
+            # Once every indexed creature is a candidate a larger radius finds nothing new
+            covered = len(candidates) == len(index) or radius >= board.length + board.height
+
+            targets = {}
+            for creature in candidates:
+                # The index is built at the start of the epoch, check the candidate is still eligible
+                if creature.board is board and self.subject.can_mate(creature):
+                    targets.setdefault((creature.x, creature.y), creature)
+
+            if targets:
+                # Paths around obstacles can be longer than any radius, so the last wave is unbounded
+                partner, exhausted = self.nearest_by_path(targets, board.length * board.height if covered else radius)
+                if partner is not None:
+                    self._partner = partner
+                    return
+                if exhausted:
+                    return
+
+            if covered:
+                return
+            radius *= 2
+
+    def nearest_by_path(self, targets, max_steps):
+        """Closest of {(x, y): partner} by path, and whether every reachable cell was seen
+
+        Cells are waved through like in flood_search, but only for max_steps
+        steps and looking up the target cells instead of every element.
+        """
+        board = self.subject.board
+        current_wave = [(self.subject.x, self.subject.y)]
+        checked = {(self.subject.x, self.subject.y)}
+
+        for step in range(max_steps):
+            next_wave = []
+
+            for x, y in current_wave:
+                for coordinates in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                    if coordinates in checked or not board.coordinates_valid(*coordinates):
+                        continue
+                    if coordinates in targets:
+                        return targets[coordinates], False
+
+                    checked.add(coordinates)
+                    if board.cell_passable(*coordinates):
+                        next_wave.append(coordinates)
+
+            if not next_wave:
+                return None, True
+            current_wave = next_wave
+
+        return None, False
+
+    def flood_search(self):
         current_wave = [(self.subject.x, self.subject.y)]
-        checked = {self.subject.x, self.subject.y}
+        checked = {(self.subject.x, self.subject.y)}
 
         height = self.subject.board.height
         length = self.subject.board.length
@@ -506,18 +588,7 @@ class GiveBirth(Action):
         self.check_set_results()
 
     def get_empty_cells_around(self):
-        cells_near = []
-
-        if self.subject.board.cell_passable(self.subject.x, self.subject.y + 1):
-            cells_near.append((self.subject.x, self.subject.y + 1))
-        if self.subject.board.cell_passable(self.subject.x, self.subject.y - 1):
-            cells_near.append((self.subject.x, self.subject.y - 1))
-        if self.subject.board.cell_passable(self.subject.x + 1, self.subject.y):
-            cells_near.append((self.subject.x + 1, self.subject.y))
-        if self.subject.board.cell_passable(self.subject.x - 1, self.subject.y):
-            cells_near.append((self.subject.x - 1, self.subject.y))
-
-        return cells_near
+        return self.subject.board.free_cells_around(self.subject.x, self.subject.y)
 
 
 class HarvestSubstance(Action):
@@ -647,3 +718,48 @@ class GoMating(Action):
 
     def check_set_results(self):
         self.accomplished = self._done
+
+
+class TestSearchMatingPartner(unittest.TestCase):
+    def search(self, f, subject):
+        search = SearchMatingPartner(subject)
+        search.search()
+        return search.results["partner"]
+
+    def test_all_candidates_ineligible(self):
+        from fixtures import Harvesters, build_field, creature
+
+        male, female = creature(True), creature(False)
+        f = build_field(200, 200, [(1, 1, male), (198, 197, female)], demiurge=Harvesters(plan=None))
+        self.assertEqual(len(f.partner_index(False)), 1)
+
+        # Pregnant after the index of the epoch was built
+        female.add_state(states.Pregnant(female))
+
+        self.assertTrue(self.search(f, male) is None)
+
+    def test_nearest_eligible_partner(self):
+        from fixtures import Harvesters, build_field, creature
+
+        male, near, far = creature(True), creature(False), creature(False)
+        f = build_field(40, 20, [(5, 5, male), (7, 5, near), (30, 15, far)], demiurge=Harvesters(plan=None))
+        self.assertTrue(self.search(f, male) is near)
+
+        near.add_state(states.Pregnant(near))
+
+        self.assertTrue(self.search(f, male) is far)
+
+    def test_partner_behind_a_wall(self):
+        from fixtures import Harvesters, build_field, creature
+
+        # The only way around the wall is much longer than the distance across it
+        male, female = creature(True), creature(False)
+        layout = [(10, y, entities.Block()) for y in range(1, 28)]
+        layout.extend([(9, 1, male), (11, 1, female)])
+        f = build_field(21, 30, layout, demiurge=Harvesters(plan=None))
+
+        self.assertTrue(self.search(f, male) is female)
+
+
+if __name__ == '__main__':
+    unittest.main()
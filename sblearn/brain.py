@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+import random
 import unittest
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.exceptions import NotFittedError
 
 
 class LearningMemory(object):
     def __init__(self, host):
         self.host = host
         self.memories = {}
+        self.new_results = 0
 
     def save_state(self, state, action):
         self.memories[action] = {"state": state}
@@ -13,6 +19,7 @@ class LearningMemory(object):
     def save_results(self, results, action):
         if action in self.memories:
             self.memories[action]["results"] = results
+            self.new_results += 1
         else:
             pass
 
@@ -30,6 +37,92 @@ class LearningMemory(object):
 
     def obliviate(self):
         self.memories = {}
+        self.new_results = 0
+
+
+class ColumnarLearningMemory(object):
+    """LearningMemory backed by a fixed size NumPy table per action type
+
+    A saved state waits among the pending states until the results of its
+    action arrive. Then it is written as one row of features followed by
+    the target into the table of the action's type. When a table is full,
+    new rows evict either the oldest row ("fifo") or a random one
+    ("reservoir", keeping a uniform sample of all the rows seen). make_table
+    returns a view of the filled rows, not a copy, so it is only valid until
+    the next write.
+    """
+
+    def __init__(self, host, capacity=4096, eviction="fifo"):
+        if eviction not in ("fifo", "reservoir"):
+            raise ValueError("Unknown eviction policy: {0}".format(eviction))
+
+        self.host = host
+        self.capacity = capacity
+        self.eviction = eviction
+
+        self.pending = OrderedDict()
+        self.tables = {}
+        self.new_results = 0
+
+    def save_state(self, state, action):
+        self.pending.pop(action, None)
+        self.pending[action] = state
+
+        if len(self.pending) > self.capacity:
+            self.pending.popitem(last=False)
+
+    def save_results(self, results, action):
+        state = self.pending.pop(action, None)
+        if state is None:
+            return
+
+        table = self.tables.get(type(action))
+        if table is None:
+            table = {"rows": np.zeros((self.capacity, len(state) + 1)),
+                     "filled": 0,
+                     "seen": 0}
+            self.tables[type(action)] = table
+
+        if table["filled"] < self.capacity:
+            slot = table["filled"]
+            table["filled"] += 1
+        elif self.eviction == "fifo":
+            slot = table["seen"] % self.capacity
+        else:
+            slot = random.randint(0, table["seen"])
+            if slot >= self.capacity:
+                table["seen"] += 1
+                return
+
+        table["rows"][slot, :-1] = state
+        table["rows"][slot, -1] = results
+        table["seen"] += 1
+        self.new_results += 1
+
+    def make_table(self, action_type):
+        found = [table for table_type, table in self.tables.iteritems()
+                 if issubclass(table_type, action_type) and table["filled"] > 0]
+
+        if not found:
+            return np.zeros((0, 0))
+        if len(found) == 1:
+            return found[0]["rows"][:found[0]["filled"]]
+        return np.concatenate([table["rows"][:table["filled"]] for table in found])
+
+    def obliviate(self):
+        self.pending = OrderedDict()
+        for table in self.tables.itervalues():
+            table["filled"] = 0
+            table["seen"] = 0
+        self.new_results = 0
+
+
+def predict_batch(model, rows):
+    """Predictions of model for every row, or None while the model is not fitted"""
+    try:
+        return model.predict(np.asarray(rows))
+    except NotFittedError:
+        return None
 
 
 class TestLearningMemory(unittest.TestCase):
@@ -80,5 +173,66 @@ class TestLearningMemory(unittest.TestCase):
                                                     [1, 2, True]])
 
 
+class TestPredictBatch(unittest.TestCase):
+    def test_predict_batch(self):
+        from sklearn.linear_model import SGDClassifier
+
+        model = SGDClassifier(random_state=0)
+        self.assertTrue(predict_batch(model, [[0., 1.]]) is None)
+
+        model.fit([[0., 0.], [1., 1.]], [0, 1])
+        self.assertEqual(len(predict_batch(model, [[0., 0.], [1., 1.], [2., 2.]])), 3)
+
+
+class TestColumnarLearningMemory(unittest.TestCase):
+    def setUp(self):
+        self.mem = ColumnarLearningMemory(None, capacity=2)
+
+    def test_make_table(self):
+        self.mem = ColumnarLearningMemory(None)
+        self.mem.save_state([1, 2], 12)
+        self.mem.save_state([6, 4], 65)
+        self.mem.save_state([1, 2], "42")
+        self.mem.save_results(False, 65)
+        self.mem.save_results(True, 12)
+
+        self.assertEqual(self.mem.make_table(int).tolist(), [[6, 4, 0],
+                                                             [1, 2, 1]])
+        self.assertEqual(self.mem.make_table(str).tolist(), [])
+        self.assertEqual(self.mem.new_results, 2)
+
+    def test_fifo_eviction(self):
+        for action in range(3):
+            self.mem.save_state([action, action], action)
+            self.mem.save_results(True, action)
+
+        self.assertEqual(sorted(self.mem.make_table(int)[:, 0].tolist()), [1, 2])
+
+    def test_reservoir_eviction(self):
+        random.seed(3)
+        self.mem = ColumnarLearningMemory(None, capacity=4, eviction="reservoir")
+        for action in range(200):
+            self.mem.save_state([action, 2 * action], action)
+            self.mem.save_results(action % 2 == 0, action)
+
+        table = self.mem.make_table(int)
+
+        self.assertEqual(table.shape, (4, 3))
+        self.assertEqual(self.mem.tables[int]["seen"], 200)
+        self.assertEqual(len(set(table[:, 0].tolist())), 4)
+        self.assertNotEqual(sorted(table[:, 0].tolist()), [0, 1, 2, 3])
+        for action, double, result in table.tolist():
+            self.assertEqual(double, 2 * action)
+            self.assertEqual(result, action % 2 == 0)
+
+    def test_obliviate(self):
+        self.mem.save_state([1, 2], 12)
+        self.mem.save_results(True, 12)
+        self.mem.obliviate()
+
+        self.assertEqual(len(self.mem.make_table(int)), 0)
+        self.assertEqual(self.mem.new_results, 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import Queue
+
+import numpy as np
+
+import entities
+import substances
+from snapshot import (COLUMN_TYPES, ENTITY_COLUMNS, Snapshot, capture_snapshot, element_model, entity_record,
+                      model_record, qualified_name, restore_fitted, write_snapshot_file)
+
+logger = logging.getLogger(__name__)
+
+RECORD_LENGTH = struct.Struct("<Q")
+
+
+class CheckpointJournal(object):
+    """Keyframes every keyframe_interval epochs and per-epoch deltas in between
+
+    The directory holds keyframe_<epoch>.snap snapshots (see snapshot.py),
+    with an extra entities.id array naming their entity rows, and a
+    deltas_<epoch>.log after each keyframe with one record per following
+    epoch. A record is a length-prefixed pickle of plain data: the changed
+    substance counts of the bottom scenery, the ids of entities that are
+    gone, the rows of entities that are new or changed and the models whose
+    parameters changed. Entity ids are handed out by the journal.
+
+    record() only captures the field; files are written on a background
+    thread. Keyframes are written to a temporary name and renamed, and a
+    record cut short by a crash is ignored when reading, so after a crash
+    the journal can still be read up to the last complete epoch.
+    """
+
+    def __init__(self, directory, keyframe_interval=100):
+        if keyframe_interval < 1:
+            raise ValueError("keyframe_interval must be positive, got {0}".format(keyframe_interval))
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.keyframe_interval = keyframe_interval
+
+        self.__ids = {}
+        self.__next_id = 0
+        self.__rows = None
+        self.__substance = None
+        self.__model_numbers = {}
+        self.__model_records = {}
+        self.__segment = None
+        self.__last_epoch = None
+
+        self.__error = None
+        self.__queue = Queue.Queue()
+        self.__thread = threading.Thread(target=self.__write)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def keyframe_path(self, epoch):
+        return os.path.join(self.directory, "keyframe_{0:010d}.snap".format(epoch))
+
+    def deltas_path(self, epoch):
+        return os.path.join(self.directory, "deltas_{0:010d}.log".format(epoch))
+
+    def keyframes(self):
+        found = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith("keyframe_") and filename.endswith(".snap"):
+                found.append(int(filename[len("keyframe_"):-len(".snap")]))
+        return sorted(found)
+
+    def latest_epoch(self):
+        """Last epoch that can be rebuilt from the files on disk, or None"""
+        self.flush()
+
+        keyframes = self.keyframes()
+        if not keyframes:
+            return None
+
+        latest = keyframes[-1]
+        for record in self.__records(latest):
+            latest = record["epoch"]
+        return latest
+
+    def record(self, field):
+        self.__check_writer()
+
+        epoch = field.epoch
+        if self.__last_epoch is not None and epoch <= self.__last_epoch:
+            raise ValueError("Epoch {0} is already recorded".format(epoch))
+
+        if self.__segment is None or epoch % self.keyframe_interval == 0:
+            self.__keyframe(field)
+        else:
+            self.__delta(field)
+
+        self.__last_epoch = epoch
+
+    def flush(self):
+        """Waits until everything recorded so far is on disk"""
+        self.__queue.join()
+        self.__check_writer()
+
+    def snapshot_at(self, epoch):
+        """Snapshot-like tables of a recorded epoch, for Field.from_snapshot"""
+        self.flush()
+
+        keyframes = [keyframe for keyframe in self.keyframes() if keyframe <= epoch]
+        if not keyframes:
+            raise ValueError("No keyframe at or before epoch {0}".format(epoch))
+
+        with Snapshot(self.keyframe_path(keyframes[-1])) as snapshot:
+            tables = JournalTables(snapshot)
+
+        for record in self.__records(keyframes[-1]):
+            if record["epoch"] > epoch:
+                break
+            tables.apply(record)
+
+        if tables.epoch != epoch:
+            raise ValueError("Epoch {0} is not in the journal".format(epoch))
+
+        return tables
+
+    def __check_writer(self):
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise error
+
+    def __write(self):
+        while True:
+            task = self.__queue.get()
+            try:
+                task()
+            except Exception as error:
+                logger.exception("Checkpoint write failed")
+                self.__error = error
+            finally:
+                self.__queue.task_done()
+
+    def __records(self, keyframe):
+        path = self.deltas_path(keyframe)
+        if not os.path.exists(path):
+            return
+
+        with open(path, "rb") as f:
+            while True:
+                prefix = f.read(RECORD_LENGTH.size)
+                if len(prefix) < RECORD_LENGTH.size:
+                    return
+                data = f.read(RECORD_LENGTH.unpack(prefix)[0])
+                if len(data) < RECORD_LENGTH.unpack(prefix)[0]:
+                    return
+                yield pickle.loads(data)
+
+    def __id_of(self, element):
+        if element not in self.__ids:
+            self.__ids[element] = self.__next_id
+            self.__next_id += 1
+        return self.__ids[element]
+
+    def __capture_rows(self, stacked):
+        rows = {}
+        for element, position in zip(stacked, stack_positions((element.x, element.y) for element in stacked)):
+            model = element_model(element)
+            number = -1 if model is None else self.__model_numbers[id(model)]
+            values, element_states = entity_record(element)
+            rows[self.__id_of(element)] = (qualified_name(type(element)), values, number,
+                                           tuple((qualified_name(state_type), duration, timing)
+                                                 for state_type, duration, timing in element_states),
+                                           position)
+
+        self.__ids = dict((element, self.__ids[element]) for element in stacked)
+        return rows
+
+    def __capture_substance(self, field):
+        if field.layers is not None:
+            return field.layers.substance.copy()
+
+        found = {}
+        for x, y in field.find_all_coordinates_by_type(substances.Substance):
+            bottom = field.get_cell(x, y)[0]
+            if type(bottom) in (entities.Blank, entities.Block):
+                found[y * field.length + x] = bottom.count_substance_of_type(substances.Substance)
+        return found
+
+    def __keyframe(self, field):
+        header, arrays, stacked, models = capture_snapshot(field)
+
+        self.__model_numbers = dict((id(model), number) for number, model in enumerate(models))
+        self.__model_records = dict((number, model_record(model)) for number, model in enumerate(models))
+        self.__rows = self.__capture_rows(stacked)
+        self.__substance = self.__capture_substance(field)
+        self.__segment = field.epoch
+
+        arrays.append(("entities.id", np.array([self.__ids[element] for element in stacked], dtype=np.int64)))
+
+        path = self.keyframe_path(field.epoch)
+        deltas_path = self.deltas_path(field.epoch)
+
+        def write():
+            if os.path.exists(deltas_path):
+                os.remove(deltas_path)
+            write_snapshot_file(path + ".tmp", header, arrays)
+            os.rename(path + ".tmp", path)
+
+        self.__queue.put(write)
+
+    def __delta(self, field):
+        stacked = field.stacked_elements()
+
+        models = {}
+        for element in stacked:
+            model = element_model(element)
+            if model is None:
+                continue
+            if id(model) not in self.__model_numbers:
+                self.__model_numbers[id(model)] = len(self.__model_numbers)
+
+            number = self.__model_numbers[id(model)]
+            if number in models:
+                continue
+            current = model_record(model)
+            if not same_model_record(current, self.__model_records.get(number)):
+                self.__model_records[number] = current
+                models[number] = current
+
+        rows = self.__capture_rows(stacked)
+        substance = self.__capture_substance(field)
+
+        if field.layers is not None:
+            changed = np.flatnonzero(substance != self.__substance)
+            substance_changes = (changed, substance.ravel()[changed])
+        else:
+            changed = sorted(index for index in set(substance) | set(self.__substance)
+                             if substance.get(index, 0) != self.__substance.get(index, 0))
+            substance_changes = (np.array(changed, dtype=np.int64),
+                                 np.array([substance.get(index, 0) for index in changed], dtype=np.int32))
+
+        record = {"epoch": field.epoch,
+                  "substance": substance_changes,
+                  "removed": [entity_id for entity_id in self.__rows if entity_id not in rows],
+                  "rows": dict((entity_id, row) for entity_id, row in rows.iteritems()
+                               if self.__rows.get(entity_id) != row),
+                  "models": models}
+
+        self.__rows = rows
+        self.__substance = substance
+
+        path = self.deltas_path(self.__segment)
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+
+        def write():
+            with open(path, "ab") as f:
+                f.write(RECORD_LENGTH.pack(len(data)))
+                f.write(data)
+
+        self.__queue.put(write)
+
+
+def stack_positions(coordinates):
+    """Position of every element in its stack, for coordinates in row-major and stacking order"""
+    positions = []
+    previous = None
+    for current in coordinates:
+        positions.append(positions[-1] + 1 if current == previous else 0)
+        previous = current
+    return positions
+
+
+def same_model_record(first, second):
+    if first is None or second is None:
+        return first is second
+
+    if first[0] != second[0] or len(first[1]) != len(second[1]):
+        return False
+
+    for (first_name, first_array), (second_name, second_array) in zip(first[1], second[1]):
+        if first_name != second_name or not np.array_equal(first_array, second_array):
+            return False
+
+    return True
+
+
+class JournalTables(object):
+    """A keyframe with deltas applied, readable by Field.from_snapshot like a Snapshot"""
+
+    def __init__(self, snapshot):
+        header = snapshot.header
+        self.epoch = header["epoch"]
+        self.__base_header = dict((key, value) for key, value in header.iteritems()
+                                  if key not in ("arrays", "types", "state_types", "models", "epoch"))
+
+        self.base = np.array(snapshot.array("base"))
+        self.substance = np.array(snapshot.array("substance"))
+
+        self.models = {}
+        for number, model_header in enumerate(header["models"]):
+            self.models[number] = (model_header, [(name, np.array(snapshot.array("model{0}.{1}".format(number, name))))
+                                                  for name in model_header["arrays"]])
+
+        self.rows = {}
+        columns = dict((name, snapshot.entity_column(name)) for name in ENTITY_COLUMNS + ("type", "model", "id"))
+        entity_states = {}
+        for row in range(len(snapshot.state_column("entity"))):
+            entity_states.setdefault(int(snapshot.state_column("entity")[row]), []).append(
+                (header["state_types"][snapshot.state_column("type")[row]],
+                 int(snapshot.state_column("duration")[row]),
+                 int(snapshot.state_column("timing")[row])))
+
+        positions = stack_positions(zip(columns["x"], columns["y"]))
+        for row in range(len(columns["id"])):
+            self.rows[int(columns["id"][row])] = (header["types"][columns["type"][row]],
+                                                  tuple(int(columns[name][row]) for name in ENTITY_COLUMNS),
+                                                  int(columns["model"][row]),
+                                                  tuple(entity_states.get(row, ())),
+                                                  positions[row])
+
+        self.__tables = None
+
+    def apply(self, record):
+        self.epoch = record["epoch"]
+
+        indices, values = record["substance"]
+        self.substance.ravel()[indices] = values
+
+        for entity_id in record["removed"]:
+            del self.rows[entity_id]
+        self.rows.update(record["rows"])
+        self.models.update(record["models"])
+
+        self.__tables = None
+
+    def __build(self):
+        if self.__tables is not None:
+            return self.__tables
+
+        types = []
+        state_types = []
+        columns = dict((name, []) for name in ENTITY_COLUMNS + ("type", "model", "id"))
+        state_columns = dict((name, []) for name in ("entity", "type", "duration", "timing"))
+
+        # Rows go back into their cells bottom to top, as capture_snapshot wrote them
+        ordered = sorted(self.rows.iteritems(), key=lambda item: (item[1][1][1], item[1][1][0], item[1][4]))
+        for row, (entity_id, (type_name, values, number, element_states, position)) in enumerate(ordered):
+            if type_name not in types:
+                types.append(type_name)
+            for name, value in zip(ENTITY_COLUMNS, values):
+                columns[name].append(value)
+            columns["type"].append(types.index(type_name))
+            columns["model"].append(number)
+            columns["id"].append(entity_id)
+
+            for state_type, duration, timing in element_states:
+                if state_type not in state_types:
+                    state_types.append(state_type)
+                state_columns["entity"].append(row)
+                state_columns["type"].append(state_types.index(state_type))
+                state_columns["duration"].append(duration)
+                state_columns["timing"].append(timing)
+
+        arrays = {"base": self.base, "substance": self.substance}
+        for name, values in columns.iteritems():
+            arrays["entities." + name] = np.array(values, dtype=COLUMN_TYPES.get(name, np.int64))
+        for name, values in state_columns.iteritems():
+            arrays["states." + name] = np.array(values, dtype=COLUMN_TYPES[name])
+
+        header = dict(self.__base_header, epoch=self.epoch, types=types, state_types=state_types,
+                      models=[self.models[number][0] for number in sorted(self.models)])
+
+        self.__tables = (header, arrays)
+        return self.__tables
+
+    @property
+    def header(self):
+        return self.__build()[0]
+
+    def array(self, name):
+        return self.__build()[1][name]
+
+    def entity_column(self, name):
+        return self.array("entities." + name)
+
+    def state_column(self, name):
+        return self.array("states." + name)
+
+    def restore_model(self, number, model):
+        model_header, model_arrays = self.models[number]
+        restore_fitted(model, model_header, model_arrays)
+
+
+class TestCheckpointJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def summary(self, f):
+        # Every cell from the bottom up with the recorded values of its elements, only substance for the scenery
+        return [[(type(element).__name__, element.count_substance_of_type(substances.Substance)) if index == 0 else
+                 (type(element).__name__,) + entity_record(element)[0][2:] +
+                 (tuple((state_type.__name__, duration, timing)
+                        for state_type, duration, timing in entity_record(element)[1]),)
+                 for index, element in enumerate(f.get_cell(x, y))]
+                for y in range(f.height) for x in range(f.length)]
+
+    def record(self, f, epochs, keyframe_interval):
+        from fixtures import Harvesters
+
+        f.set_checkpoints(CheckpointJournal(self.directory, keyframe_interval=keyframe_interval))
+        recorded = {f.epoch: self.summary(f)}
+        for _ in range(epochs):
+            f.make_time()
+            recorded[f.epoch] = self.summary(f)
+        f.checkpoints.flush()
+        return recorded, Harvesters
+
+    def test_seek(self):
+        from fixtures import build_field, creature
+
+        layout = [(8, y, entities.Block()) for y in range(3, 9)]
+        layout.extend([(2, 2, creature(True)), (14, 9, creature(False)), (5, 10, creature(False)),
+                       (12, 3, entities.BreedingGround())])
+        f = build_field(20, 12, layout)
+        recorded, demiurge_type = self.record(f, 10, 4)
+        journal = f.checkpoints
+
+        self.assertEqual(journal.keyframes(), [0, 4, 8])
+        self.assertEqual(journal.latest_epoch(), 10)
+        self.assertNotEqual(recorded[4], recorded[6])
+
+        for epoch in (4, 8, 6, 10):
+            restored = f.seek(epoch, demiurge_type())
+
+            self.assertEqual(restored.epoch, epoch)
+            self.assertEqual(self.summary(restored), recorded[epoch])
+            self.assertTrue(restored.integrity_check("full").ok)
+
+        self.assertRaises(ValueError, f.seek, 11)
+        self.assertRaises(ValueError, journal.record, f)
+
+    def test_seek_stacked_cell(self):
+        from fixtures import Harvesters, build_field, cells, creature
+
+        # The creature gets the lower id at the keyframe, then steps onto the breeding ground
+        walker = creature(True)
+        f = build_field(8, 5, [(2, 1, walker), (5, 3, entities.BreedingGround())], demiurge=Harvesters(plan=None))
+        f.make_time()
+        f.make_time()
+        f.set_checkpoints(CheckpointJournal(self.directory, keyframe_interval=10))
+
+        f.remove_object(walker)
+        f.insert_object(5, 3, walker)
+        f.make_time()
+        f.checkpoints.flush()
+
+        self.assertEqual(cells(f)[3 * 8 + 5], ["Blank", "BreedingGround", "Creature"])
+
+        restored = f.seek(f.epoch, Harvesters(plan=None))
+
+        self.assertEqual(cells(restored), cells(f))
+        self.assertEqual(restored.get_stats(), f.get_stats())
+        self.assertEqual(self.summary(restored), self.summary(f))
+
+
+if __name__ == '__main__':
+    unittest.main()
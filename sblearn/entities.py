@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import logging
+import math
 import random
 import numpy as np
 
@@ -8,6 +10,13 @@ import brain
 import states
 import substances
 
+logger = logging.getLogger(__name__)
+
+
+def geometric(probability):
+    """Number of Bernoulli trials up to and including the first success"""
+    return max(1, int(math.ceil(math.log(1. - random.random()) / math.log(1. - probability))))
+
 
 class Entity(object):
     def __init__(self):
@@ -49,6 +58,30 @@ class Entity(object):
         self.z += 1
         self.age += 1
 
+    def next_wake_up(self):
+        return self.z
+
+    def wake_up(self, epoch):
+        slept = epoch - self.z
+        if slept > 0:
+            for state in self._states_list:
+                state.catch_up(slept)
+            self.age += slept
+            self.z = epoch
+
+        self.live()
+
+    def states_wake_up(self):
+        wake_ups = []
+        for state in self._states_list:
+            ticks = state.ticks_to_timing()
+            if ticks is not None:
+                wake_ups.append(self.z + ticks - 1)
+
+        if not wake_ups:
+            return None
+        return min(wake_ups)
+
     def get_affected(self):
         for state in self._states_list:
             state.affect()
@@ -61,9 +94,15 @@ class Entity(object):
 
     def add_state(self, state):
         self._states_list.append(state)
+        self._schedule_changed()
 
     def remove_state(self, state):
         self._states_list.remove(state)
+        self._schedule_changed()
+
+    def _schedule_changed(self):
+        if self.board is not None:
+            self.board.reschedule(self)
 
     def contains(self, substance_type):
         for element in self._container:
@@ -79,11 +118,25 @@ class Entity(object):
                 break
         if substance_index is None:
             return None
-        return self._container.pop(substance_index)
+        substance_object = self._container.pop(substance_index)
+        self._container_changed()
+        return substance_object
 
     def pocket(self, substance_object):
         if substance_object is not None:
             self._container.append(substance_object)
+            self._container_changed()
+
+    def substance_types(self):
+        return set(type(element) for element in self._container)
+
+    def _container_changed(self):
+        if self.board is not None:
+            self.board.container_changed(self)
+
+    def _life_changed(self):
+        if self.board is not None:
+            self.board.life_changed(self)
 
     def dissolve(self):
         self.board.remove_object(self)
@@ -98,10 +151,17 @@ class Entity(object):
 
 
 class Blank(Entity):
+    substance_probability = 0.0004
+
+    color_empty = "#004400"
+    color_full = "#224444"
+
     def __init__(self):
         super(Blank, self).__init__()
         self.passable = True
-        self.color = "#004400"
+        self.color = self.color_empty
+
+        self._next_spawn = None
 
     def __str__(self):
         return '.'
@@ -111,15 +171,33 @@ class Blank(Entity):
         return "Blank"
 
     def live(self):
+        # Under the event scheduler the spawn epoch is drawn in advance
+        if self._next_spawn is None:
+            spawn = random.random() <= self.substance_probability
+        else:
+            spawn = self.z == self._next_spawn
+
         super(Blank, self).live()
 
-        if random.random() <= 0.0004:
-            self._container.append(substances.Substance())
+        if spawn:
+            self.pocket(substances.Substance())
+
+        self.update_color()
 
+    def update_color(self):
         if len(self._container) > 0:
-            self.color = "#224444"
+            self.color = self.color_full
         else:
-            self.color = "#004400"
+            self.color = self.color_empty
+
+    def next_wake_up(self):
+        if self._next_spawn is None or self._next_spawn < self.z:
+            self._next_spawn = self.z + geometric(self.substance_probability) - 1
+
+        states_wake_up = self.states_wake_up()
+        if states_wake_up is None:
+            return self._next_spawn
+        return min(self._next_spawn, states_wake_up)
 
 
 class Block(Entity):
@@ -135,6 +213,9 @@ class Block(Entity):
     def class_name(cls):
         return "Block"
 
+    def next_wake_up(self):
+        return self.states_wake_up()
+
 
 class Agent(Entity):
     def __init__(self):
@@ -151,13 +232,19 @@ class Agent(Entity):
         self.public_decision_model = None
 
         self.plan_callable = None
+        self.decision_task = None
+        self.decision = None
 
         self.memory_type = ""
         self.model_type = ""
 
         self.memory_batch_size = 1
+        self.training_mode = "fit"
+        self.training_classes = None
+        self.trainer = None
 
         self.memorize_tasks = {}
+        self.features_cache = {}
         self.chosen_action = None
 
     @classmethod
@@ -228,8 +315,41 @@ class Agent(Entity):
 
         return results
 
+    def decision_model(self):
+        if self.trainer is not None:
+            return self.trainer.model
+
+        if self.model_type == "public":
+            return self.public_decision_model
+        elif self.model_type == "private":
+            return self.private_decision_model
+
+        return None
+
+    def decision_request(self):
+        """Decision model and features the agent will predict with when it plans this epoch, or None"""
+        if self.decision_task is None or not self.need_to_update_plan():
+            return None
+
+        model = self.decision_model()
+        if model is None:
+            return None
+
+        return model, self.get_features(self.decision_task)
+
+    def decide(self):
+        """Decision model prediction for the features of decision_task
+
+        Uses the prediction made by the field's planning phase when there is
+        one for the current epoch, otherwise asks the model for this agent alone.
+        """
+        if self.decision is not None and self.board is not None and self.decision[0] == self.board.epoch:
+            return self.decision[1]
+
+        current_features = np.asarray(self.get_features(self.decision_task)).reshape(1, -1)
+        return self.decision_model().predict(current_features)[0]
+
     def update_decision_model(self):
-        model_to_use = None
         memory_to_use = None
 
         if self.memory_type == "public":
@@ -237,43 +357,70 @@ class Agent(Entity):
         elif self.memory_type == "private":
             memory_to_use = self.private_learning_memory
 
-        if self.model_type == "public":
-            model_to_use = self.public_decision_model
-        elif self.model_type == "private":
-            model_to_use = self.private_decision_model
+        model_to_use = self.decision_model()
 
         if memory_to_use is None or model_to_use is None:
             raise Exception("You should set memory and model types ('public' or 'private')")
 
+        if self.training_mode not in ("fit", "partial_fit"):
+            raise ValueError("Unknown training mode: {0}".format(self.training_mode))
+
+        # Nothing to learn until new results have been saved
+        if not memory_to_use.new_results:
+            return
+        memory_to_use.new_results = 0
+
         table_list = memory_to_use.make_table(actions.GoMating)
         if len(table_list) >= self.memory_batch_size:
             df_train = np.asarray(table_list)
-            # print df_train
             target_column = len(table_list[0])-1
-            unique_targets = np.unique(df_train[:, target_column])  # TODO maybe discard
-            if len(unique_targets) > 1:
-                y_train = df_train[:, [target_column]].ravel()
-                X_train = np.delete(df_train, target_column, 1)
-                model_to_use.fit(X_train, y_train)
-                memory_to_use.obliviate()
-                print "Update successful"
+            y_train = df_train[:, target_column]
+            X_train = df_train[:, :target_column]
+
+            if self.training_mode == "partial_fit" and self.training_classes is None:
+                raise ValueError("partial_fit training needs training_classes")
+
+            if self.training_mode == "fit" and len(np.unique(y_train)) < 2:
+                logger.debug("Memory discarded")
+            elif self.trainer is not None:
+                self.trainer.submit(X_train, y_train, self.training_mode, self.training_classes)
+                logger.debug("Submitted %d rows for training", len(table_list))
+            elif self.training_mode == "partial_fit":
+                model_to_use.partial_fit(X_train, y_train, classes=np.asarray(self.training_classes))
+                logger.debug("Partial update on %d rows", len(table_list))
             else:
-                memory_to_use.obliviate()
-                print "Memory discarded"
+                model_to_use.fit(X_train, y_train)
+                logger.debug("Update successful")
 
-    def set_memorize_task(self, action_types, features_list, target):
+            memory_to_use.obliviate()
+
+    def set_memorize_task(self, action_types, features_list, target, cache_features=False):
+        """With cache_features the features of an action type are evaluated at most once per epoch"""
         if isinstance(action_types, list):
             for action_type in action_types:
                 self.memorize_tasks[action_type] = {"features": features_list,
-                                                    "target": target}
+                                                    "target": target,
+                                                    "cache_features": cache_features}
         else:
             self.memorize_tasks[action_types] = {"features": features_list,
-                                                 "target": target}
+                                                 "target": target,
+                                                 "cache_features": cache_features}
 
     def get_features(self, action_type):
         if action_type not in self.memorize_tasks:
             return None
 
+        if not self.memorize_tasks[action_type].get("cache_features") or self.board is None:
+            return self.evaluate_features(action_type)
+
+        epoch, features_list = self.features_cache.get(action_type, (None, None))
+        if epoch != self.board.epoch:
+            features_list = self.evaluate_features(action_type)
+            self.features_cache[action_type] = (self.board.epoch, features_list)
+
+        return list(features_list)
+
+    def evaluate_features(self, action_type):
         features_list_raw = self.memorize_tasks[action_type]["features"]
         features_list = []
 
@@ -327,13 +474,19 @@ class Creature(Agent):
         self.public_decision_model = None
 
         self.plan_callable = None
+        self.decision_task = None
+        self.decision = None
 
         self.memory_type = ""
         self.model_type = ""
 
         self.memory_batch_size = 1
+        self.training_mode = "fit"
+        self.training_classes = None
+        self.trainer = None
 
         self.memorize_tasks = {}
+        self.features_cache = {}
         self.chosen_action = None
 
     def __str__(self):
@@ -362,6 +515,7 @@ class Creature(Agent):
             return
         self.alive = False
         self.time_of_death = self.z
+        self._life_changed()
 
     def set_sex(self, sex):
         self.sex = sex
@@ -370,17 +524,16 @@ class Creature(Agent):
         else:
             self.color = "#990000"
 
+    def mating_ready(self):
+        if not self.alive:
+            return False
+
+        return self.sex or not self.has_state(states.Pregnant)
+
     def can_mate(self, with_who):
         if isinstance(with_who, Creature):
             if with_who.sex != self.sex:
-
-                if not self.alive or not with_who.alive:
-                    return False
-
-                if self.sex:
-                    return not with_who.has_state(states.Pregnant)
-                else:
-                    return not self.has_state(states.Pregnant)
+                return self.mating_ready() and with_who.mating_ready()
 
         return False
 
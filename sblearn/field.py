@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 
-from entities import *
+import copy
+import cProfile
+import gc
 import pickle
-import threading
 
-import cProfile
+from brain import predict_batch
+from entities import *
+from integrity import INTEGRITY_LEVELS, IntegrityReport
+from pathfinding import BucketIndex, DistanceField, PathCache, PATHFINDERS
+from scheduler import EventScheduler, SCHEDULERS
+from snapshot import Snapshot, write_snapshot, resolve, BASE_BLOCK
+from storage import STORAGE_ENGINES
 
 
 def profile(func):
@@ -21,29 +28,77 @@ def profile(func):
 
 
 class Field(object):
-    def __init__(self, length, height):
+    def __init__(self, length, height, storage="objects", scheduler="scan", pathfinder="astar"):
+        if storage not in STORAGE_ENGINES:
+            raise ValueError("{0} is not a valid storage engine".format(storage))
+        if scheduler not in SCHEDULERS:
+            raise ValueError("{0} is not a valid scheduler".format(scheduler))
+        if pathfinder not in PATHFINDERS:
+            raise ValueError("{0} is not a valid pathfinder".format(pathfinder))
+
         self.__length = length
         self.__height = height
-        self.__field = []
         self.__epoch = 0
         self.pause = False
 
         self.demiurge = None
 
-        for y in range(self.__height):
-            row = []
-            self.__field.append(row)
-            for x in range(self.__length):
-                if y == 0 or x == 0 or y == (height - 1) or x == (length - 1):
-                    init_object = Block()
-                else:
-                    init_object = Blank()
-
-                init_object.x = x
-                init_object.y = y
-                init_object.z = 0
-
-                row.append([init_object])
+        self.storage_type = storage
+        self.__storage = STORAGE_ENGINES[storage](self, length, height)
+
+        self.scheduler_type = scheduler
+        self.__scheduler = None
+        if scheduler == "events":
+            self.__scheduler = EventScheduler()
+            for entity_object in self.__storage.locations.keys():
+                self.reschedule(entity_object)
+
+        self.pathfinder = PATHFINDERS[pathfinder](self)
+        self.path_cache = PathCache()
+        self.__distance_fields = {}
+        self.__partner_indexes = {}
+
+        self.checkpoints = None
+        self.population_history = None
+
+        self.integrity_level = "full"
+        self.integrity_sample_size = 100
+        self.integrity_report = None
+        self.__integrity_random = random.Random()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["checkpoints"] = None
+        return state
+
+    def clone(self, share_models=False):
+        twin = Field.__new__(Field)
+        memo = {id(self): twin,
+                id(self.__distance_fields): {},
+                id(self.__partner_indexes): {}}
+
+        if self.path_cache is not None:
+            memo[id(self.path_cache)] = PathCache()
+
+        if share_models:
+            shared = [self.demiurge]
+            for agent in self.find_all_entities_by_type(Agent):
+                shared.extend([agent.public_memory, agent.private_learning_memory,
+                               agent.public_decision_model, agent.private_decision_model, agent.trainer])
+            for shared_object in shared:
+                memo[id(shared_object)] = shared_object
+
+        # The copy allocates an object per cell and none of them is garbage
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.__storage.prepare_clone(twin, memo)
+            twin.__dict__.update(copy.deepcopy(self.__getstate__(), memo))
+        finally:
+            if collecting:
+                gc.enable()
+
+        return twin
 
     @property
     def epoch(self):
@@ -57,28 +112,56 @@ class Field(object):
     def height(self):
         return self.__height
 
+    @property
+    def layers(self):
+        if self.storage_type != "layers":
+            return None
+        return self.__storage
+
     def _get_field(self):
-        return self.__field
+        return self.__storage.as_lists()
 
     def get_cell(self, x, y):
-        return self.__field[y][x]
+        return self.__storage.get_cell(x, y)
+
+    def get_top(self, x, y):
+        return self.__storage.top(x, y)
+
+    @property
+    def passability(self):
+        return self.__storage.passable
+
+    @property
+    def passability_flat(self):
+        return self.__storage.passable_flat
+
+    @property
+    def passability_version(self):
+        return self.__storage.passability_version
+
+    @property
+    def opened_version(self):
+        return self.__storage.opened_version
 
     def cell_passable(self, x, y):
-        return self.__field[y][x][-1].passable
+        return self.__storage.cell_passable(x, y)
+
+    def free_cells_around(self, x, y):
+        return self.__storage.free_cells_around(x, y)
 
     def print_field(self):
         for y in range(self.height):
             row_str = ''
-            for element in self.__field[y]:
-                row_str += str(element[-1]) + ' '
+            for x in range(self.length):
+                row_str += str(self.get_top(x, y)) + ' '
             print row_str
 
     def list_str_representation(self):
         representation = []
         for y in range(self.height):
             row_str = ''
-            for element in self.__field[y]:
-                row_str += str(element[-1])
+            for x in range(self.length):
+                row_str += str(self.get_top(x, y))
             representation.append(row_str)
         return representation
 
@@ -86,8 +169,8 @@ class Field(object):
         representation = []
         for y in range(self.height):
             row_list = []
-            for cell in self.__field[y]:
-                row_list.append(cell[-1])
+            for x in range(self.length):
+                row_list.append(self.get_top(x, y))
             representation.append(row_list)
         return representation
 
@@ -101,10 +184,7 @@ class Field(object):
         assert x < self.length
         assert y < self.height
 
-        if self.__field[y][x][-1].scenery:
-            self.__field[y][x].append(entity_object)
-        else:
-            self.__field[y][x][-1] = entity_object
+        self.__storage.insert(x, y, entity_object)
 
         entity_object.z = self.epoch + epoch_shift
 
@@ -112,225 +192,298 @@ class Field(object):
         entity_object.x = x
         entity_object.y = y
 
+        self.reschedule(entity_object)
+
     def remove_object(self, entity_object, x=None, y=None):
-        if x is not None and y is not None:
-            cell = self.get_cell(x, y)
-            cell.remove(entity_object)
-        else:
-            for row in self.__field:
-                for cell in row:
-                    if entity_object in cell:
-                        cell.remove(entity_object)
+        if x is None or y is None:
+            coordinates = self.locate(entity_object)
+            if coordinates is None:
+                return
+            x, y = coordinates
 
-    def make_time(self):
-        if self.pause:
-            return
+        self.__storage.remove(entity_object, x, y)
 
-        for y in range(self.height):
-            for x in range(self.length):
-                for element in self.__field[y][x]:
-                    if element.z == self.epoch:
-                        element.live()
+        if self.__scheduler is not None:
+            self.__scheduler.cancel(entity_object)
 
-        self.__epoch += 1
+    def locate(self, entity_object):
+        return self.__storage.locate(entity_object)
 
-    def _make_time(self):
-        if self.pause:
+    def reschedule(self, entity_object, earliest=None):
+        if self.__scheduler is None or self.locate(entity_object) is None:
             return
 
-        threads_list = []
+        wake_up = entity_object.next_wake_up()
+        if wake_up is not None and earliest is not None:
+            wake_up = max(wake_up, earliest)
 
-        for y in range(self.height):
-            for x in range(self.length):
-                for element in self.__field[y][x]:
-                    if element.z == self.epoch:
-                        threads_list.append(threading.Thread(target=element.live))
+        self.__scheduler.schedule(entity_object, wake_up)
 
-        for t in threads_list:
-            t.start()
+    def make_time(self):
+        if self.pause:
+            return
 
-        wait = True
+        self.__storage.step_scenery(self.epoch)
+        self.plan_decisions()
 
-        while wait:
-            wait = False
-            for t in threads_list:
-                if t.isAlive():
-                    wait = True
+        if self.__scheduler is None:
+            for element in self.__storage.iter_live_elements(self.epoch):
+                element.live()
+        else:
+            for element in self.__scheduler.pop_due(self.epoch):
+                if self.locate(element) is None:
                     continue
+                element.wake_up(self.epoch)
+                self.reschedule(element, earliest=self.epoch + 1)
 
         self.__epoch += 1
 
-    def integrity_check(self):
-        error_list = []
-        # First we check the __field structure
-        # and make full list of objects
-        objects_full_list = []
-        if len(self.__field) != self.height:
-            error_str = "Field height ({0}) is not equal to the number of rows({1})".format(self.height,
-                                                                                            len(self.__field))
-            error_list.append(error_str)
-        for y, row in enumerate(self.__field):
-            if len(row) != self.length:
-                error_str = "Field length ({0}) is not equal to the number of cells ({1}) in row {2}".format(
-                    self.height, len(self.__field), y)
-                error_list.append(error_str)
-            for x, cell in enumerate(row):
-                if len(cell) == 0:
-                    error_str = "Absolute vacuum (empty list) at coordinates x:{0} y:{1}".format(x, y)
-                    error_list.append(error_str)
-                for element in cell:
-                    objects_full_list.append(element)
-                    if element.x != x or element.y != y:
-                        error_str = "Object at coordinates x:{0} y:{1} thinks it's at x:{2} y:{3}".format(x, y,
-                                                                                                          element.x,
-                                                                                                          element.y)
-                        error_list.append(error_str)
-                    if element.z != self.epoch:
-                        error_str = "Object {0} at spacial coordinates x:{1} y:{2} travels in time. Global " \
-                                    "epoch: {3}, its local time: {4}".format(str(element), x, y, self.epoch, element.z)
-                        error_list.append(error_str)
-
-        # Then we check for object doubles
-
-        for line in error_list:
-            print line
-        return error_list
+        if self.checkpoints is not None:
+            self.checkpoints.record(self)
+        if self.population_history is not None:
+            self.population_history.record(self)
 
-    def get_stats(self):
-        stats = {}
-
-        for row in self.__field:
-            for cell in row:
-                for element in cell:
-                    class_name = element.class_name()
-
-                    if class_name not in stats:
-                        stats[class_name] = 1
-                    else:
-                        stats[class_name] += 1
-
-        return stats
+    def _make_time(self):
+        # Entities share cells, memories and models, so stepping them on threads only races; step them in order
+        self.make_time()
+
+    def plan_decisions(self):
+        batches = []
+        batch_of_model = {}
+
+        for agent in self.find_all_entities_by_type(Agent):
+            request = agent.decision_request()
+            if request is None:
+                continue
+
+            model, features = request
+            if id(model) not in batch_of_model:
+                batch_of_model[id(model)] = len(batches)
+                batches.append((model, [], []))
+
+            model, agents, rows = batches[batch_of_model[id(model)]]
+            agents.append(agent)
+            rows.append(features)
+
+        for model, agents, rows in batches:
+            predictions = predict_batch(model, rows)
+            if predictions is None:
+                continue
+
+            for agent, prediction in zip(agents, predictions):
+                agent.decision = (self.epoch, prediction)
+
+    def trainers(self):
+        found = []
+        for trainer in [getattr(self.demiurge, "trainer", None)] + [agent.trainer for agent in
+                                                                    self.find_all_entities_by_type(Agent)]:
+            if trainer is not None and trainer not in found:
+                found.append(trainer)
+        return found
+
+    def close(self):
+        for trainer in self.trainers():
+            trainer.close()
+            trainer.join()
+
+    def stacked_elements(self):
+        return self.__storage.stacked_elements()
+
+    def set_integrity_level(self, level, sample_size=None):
+        if level not in INTEGRITY_LEVELS:
+            raise ValueError("{0} is not a valid integrity level".format(level))
+
+        self.integrity_level = level
+        if sample_size is not None:
+            self.integrity_sample_size = sample_size
+        self.__storage.track_touched(level == "incremental")
+
+    def integrity_check(self, level=None):
+        if level is None:
+            level = self.integrity_level
+        if level not in INTEGRITY_LEVELS:
+            raise ValueError("{0} is not a valid integrity level".format(level))
+
+        if self.__scheduler is None:
+            on_time = None
+        else:
+            # Sleeping entities only catch up with the global epoch when they wake up
+            on_time = lambda element: element.z == self.epoch or (element.z < self.epoch and
+                                                                  self.__scheduler.sleeping(element))
 
-    def save_pickle(self, filename):
-        with open(filename, 'wb') as f:
-            pickle.dump(self, f)
+        if level == "full":
+            report = IntegrityReport(self.epoch, level, self.length * self.height,
+                                     self.__storage.integrity_errors(self.epoch, on_time))
+        else:
+            if level == "incremental":
+                cells = sorted(self.__storage.take_touched(), key=lambda coordinates: (coordinates[1], coordinates[0]))
+            elif level == "sampled":
+                number = min(self.integrity_sample_size, self.length * self.height)
+                cells = [(index % self.length, index // self.length)
+                         for index in sorted(self.__integrity_random.sample(xrange(self.length * self.height), number))]
+            else:
+                cells = []
 
-    def find_all_coordinates_by_type(self, type_to_find):
-        field = self.__field
+            violations = []
+            for x, y in cells:
+                violations.extend(self.__storage.cell_errors(x, y, self.epoch, on_time))
+            report = IntegrityReport(self.epoch, level, len(cells), violations)
 
-        list_found = []
+        self.integrity_report = report
+        return report
 
-        for y, row in enumerate(field):
-            for x, cell in enumerate(row):
-                for element in cell:
-                    if isinstance(element, type_to_find):
-                        if (x, y) not in list_found:
-                            list_found.append((x, y))
-                    if element.contains(type_to_find):
-                        if (x, y) not in list_found:
-                            list_found.append((x, y))
+    def get_stats(self):
+        return self.__storage.count_classes()
 
-        return list_found
+    def get_totals(self):
+        return self.__storage.totals()
 
-    def find_all_entities_by_type(self, type_to_find):
-        field = self.__field
+    def set_population_history(self, history):
+        self.population_history = history
+        if history is not None:
+            history.record(self)
 
-        list_found = []
+    def save_pickle(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(self, f)
 
-        for row in field:
-            for cell in row:
-                for element in cell:
-                    if isinstance(element, type_to_find):
-                        if element not in list_found:
-                            list_found.append(element)
+    def set_checkpoints(self, checkpoints):
+        self.checkpoints = checkpoints
+        if checkpoints is not None:
+            checkpoints.record(self)
+
+    def seek(self, epoch, demiurge=None):
+        if self.checkpoints is None:
+            raise ValueError("The field has no checkpoints to seek in")
+        return Field.from_snapshot(self.checkpoints.snapshot_at(epoch), demiurge)
+
+    def save_snapshot(self, filename):
+        write_snapshot(self, filename)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, demiurge=None):
+        header = snapshot.header
+        field = cls(header["length"], header["height"], storage=header["storage"],
+                    scheduler=header["scheduler"], pathfinder=header["pathfinder"] or "astar")
+        field.__restart_at(header["epoch"])
+        field.set_demiurge(demiurge)
+
+        for y, x in zip(*np.nonzero(snapshot.array("base") == BASE_BLOCK)):
+            if not isinstance(field.get_cell(x, y)[0], Block):
+                raise ValueError("Blocks under other elements at x:{0} y:{1} cannot be restored".format(x, y))
+
+        substance = snapshot.array("substance")
+        for y, x in zip(*np.nonzero(substance)):
+            bottom = field.get_cell(x, y)[0]
+            for _ in range(substance[y, x]):
+                bottom.pocket(substances.Substance())
+
+        types = [resolve(name) for name in header["types"]]
+        state_types = [resolve(name) for name in header["state_types"]]
+        column = snapshot.entity_column
+
+        restored = []
+        for row in range(len(column("type"))):
+            entity_object = types[column("type")[row]]()
+            if column("sex")[row] >= 0:
+                if hasattr(entity_object, "set_sex"):
+                    entity_object.set_sex(bool(column("sex")[row]))
+                else:
+                    entity_object.sex = bool(column("sex")[row])
 
-        return list_found
+            field.insert_object(int(column("x")[row]), int(column("y")[row]), entity_object)
 
-    def make_path(self, x1, y1, x2, y2):
+            entity_object.z = int(column("z")[row])
+            entity_object.age = int(column("age")[row])
+            entity_object.alive = bool(column("alive")[row])
+            if column("time_of_death")[row] >= 0:
+                entity_object.time_of_death = int(column("time_of_death")[row])
+            field.life_changed(entity_object)
+            for _ in range(column("substance")[row]):
+                entity_object.pocket(substances.Substance())
 
-        if not self.cell_passable(x2, y2):
-            return []
+            restored.append(entity_object)
 
-        field_map = self.__make_map()
-        self.__wave(field_map, x1, y1, x2, y2)
+        for row in range(len(snapshot.state_column("entity"))):
+            entity_object = restored[snapshot.state_column("entity")[row]]
+            state = state_types[snapshot.state_column("type")[row]](entity_object)
+            state.duration = int(snapshot.state_column("duration")[row])
+            timing = int(snapshot.state_column("timing")[row])
+            state.timing = None if timing < 0 else timing
+            entity_object.add_state(state)
 
-        return self.__find_backwards(field_map, x2, y2)
+        models_restored = set()
+        for row, entity_object in enumerate(restored):
+            field.reschedule(entity_object)
 
-    def __make_map(self):
-        field_map = []
-
-        for input_row in self.__field:
-            row = []
-            for cell in input_row:
-                if cell[-1].passable:
-                    row.append(None)
-                else:
-                    row.append(-1)
-            field_map.append(row)
+            number = column("model")[row]
+            if number < 0 or not isinstance(entity_object, Agent):
+                continue
+            model = entity_object.decision_model()
+            if model is not None and id(model) not in models_restored:
+                snapshot.restore_model(number, model)
+                models_restored.add(id(model))
 
-        return field_map
+        return field
 
-    @staticmethod
-    def __wave(field_map, x1, y1, x2, y2):
-        current_wave_list = [(x1, y1)]
-        field_map[y1][x1] = 0
+    def __restart_at(self, epoch):
+        self.__epoch = epoch
 
-        while len(current_wave_list) > 0 and field_map[y2][x2] is None:
-            next_wave_list = []
-            for coordinates in current_wave_list:
-                x, y = coordinates
-                wave_num = field_map[y][x] + 1
+        for entity_object in self.__storage.locations.keys():
+            entity_object.z = epoch
 
-                if (len(field_map) - 1 >= y + 1) and field_map[y + 1][x] is None:
-                    field_map[y + 1][x] = wave_num
-                    next_wave_list.append((x, y + 1))
+        if self.__scheduler is not None:
+            self.__scheduler = EventScheduler()
+            for entity_object in self.__storage.locations.keys():
+                self.reschedule(entity_object)
 
-                if (y > 0) and field_map[y - 1][x] is None:
-                    field_map[y - 1][x] = wave_num
-                    next_wave_list.append((x, y - 1))
+    def container_changed(self, entity_object):
+        self.__storage.update_holder(entity_object)
 
-                if (len(field_map[y]) - 1 >= x + 1) and field_map[y][x + 1] is None:
-                    field_map[y][x + 1] = wave_num
-                    next_wave_list.append((x + 1, y))
+    def life_changed(self, entity_object):
+        self.__storage.update_life(entity_object)
 
-                if (x > 0) and field_map[y][x - 1] is None:
-                    field_map[y][x - 1] = wave_num
-                    next_wave_list.append((x - 1, y))
+    def find_all_coordinates_by_type(self, type_to_find):
+        return self.__storage.coordinates_of_type(type_to_find)
 
-            current_wave_list = next_wave_list[:]
+    def find_all_entities_by_type(self, type_to_find):
+        return self.__storage.entities_of_type(type_to_find)
 
-    @staticmethod
-    def __find_backwards(field_map, x2, y2):
-        num_steps = field_map[y2][x2]
+    def make_path(self, x1, y1, x2, y2):
 
-        if num_steps is None or num_steps == -1:
-            return None
+        if not self.cell_passable(x2, y2):
+            return []
 
-        path = [(x2, y2)]
-        num_steps -= 1
+        if self.path_cache is None:
+            return self.pathfinder.find_path(x1, y1, x2, y2)
 
-        while num_steps > 0:
+        return self.path_cache.find_path(self, x1, y1, x2, y2)
 
-            x, y = path[-1]
+    def distance_field(self, substance_type):
+        return self.__cached_field(substance_type, lambda: self.find_all_coordinates_by_type(substance_type))
 
-            possible_steps = []
+    def partner_index(self, sex):
+        epoch, index = self.__partner_indexes.get(sex, (None, None))
 
-            if (len(field_map) - 1 >= y + 1) and (field_map[y + 1][x] == num_steps):
-                possible_steps.append((x, y + 1))
-            elif (y > 0) and (field_map[y - 1][x] == num_steps):
-                possible_steps.append((x, y - 1))
-            elif (len(field_map[y]) - 1 >= x + 1) and (field_map[y][x + 1] == num_steps):
-                possible_steps.append((x + 1, y))
-            elif (x > 0) and (field_map[y][x - 1] == num_steps):
-                possible_steps.append((x - 1, y))
+        if epoch != self.epoch:
+            index = BucketIndex((creature.x, creature.y, creature) for creature in self.find_all_entities_by_type(Creature)
+                                if creature.sex == sex and creature.mating_ready())
+            self.__partner_indexes[sex] = (self.epoch, index)
 
-            path.append(random.choice(possible_steps))
+        return index
 
-            num_steps -= 1
+    def __cached_field(self, key, sources):
+        # Sources are looked up once per epoch, the field is only rebuilt when they or the passability changed
+        epoch, version, found, distances = self.__distance_fields.get(key, (None, None, None, None))
+        if epoch == self.epoch:
+            return distances
 
-        path.reverse()
+        current = frozenset(sources())
+        if distances is None or version != self.passability_version or current != found:
+            distances = DistanceField(self.passability, current)
+        self.__distance_fields[key] = (self.epoch, self.passability_version, current, distances)
 
-        return path
+        return distances
 
     def coordinates_valid(self, x, y):
         if x < 0 or y < 0:
@@ -354,12 +507,21 @@ class Field(object):
     def set_demiurge(self, demiurge):
         self.demiurge = demiurge
 
+    def set_pathfinder(self, pathfinder):
+        self.pathfinder = pathfinder
+        if self.path_cache is not None:
+            self.path_cache.clear()
+
 
 class Demiurge(object):
     def handle_creation(self, creation, refuse):
         pass
 
 
+def load_snapshot(filename):
+    return Snapshot(filename)
+
+
 def load_from_pickle(filename):
     with open(filename, 'rb') as f:
         field = pickle.load(f)
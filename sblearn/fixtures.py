@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from sklearn.linear_model import SGDClassifier
+
+import action_library as actions
+import brain
+import entities
+import field
+import substances
+
+
+def harvest(creature):
+    harvest_substance = actions.HarvestSubstance(creature)
+    harvest_substance.set_objective(target_substance_type=substances.Substance)
+    creature.queue_action(harvest_substance)
+
+
+class Harvesters(field.Demiurge):
+    """Gives creatures a shared memory and model and makes them harvest substance, or idle without plan"""
+
+    def __init__(self, plan=harvest):
+        self.plan = plan
+        self.public_memory = brain.ColumnarLearningMemory(self)
+        self.public_decision_model = SGDClassifier(max_iter=5, tol=None, random_state=0)
+
+    def handle_creation(self, creation, refuse):
+        if isinstance(creation, entities.Creature):
+            creation.public_memory = self.public_memory
+            creation.public_decision_model = self.public_decision_model
+            creation.memory_type = "public"
+            creation.model_type = "public"
+            creation.plan_callable = self.plan
+
+
+def creature(sex):
+    new_creature = entities.Creature()
+    new_creature.set_sex(sex)
+    return new_creature
+
+
+def build_field(length, height, layout=(), demiurge=None, **kwargs):
+    """Field with a Harvesters demiurge (unless one is given) and layout, a list of (x, y, entity)"""
+    new_field = field.Field(length, height, **kwargs)
+    new_field.set_demiurge(Harvesters() if demiurge is None else demiurge)
+    for x, y, entity_object in layout:
+        new_field.insert_object(x, y, entity_object)
+    return new_field
+
+
+def cells(board):
+    """Class names of the stacks of every cell, row by row"""
+    return [[type(element).__name__ for element in board.get_cell(x, y)]
+            for y in range(board.height) for x in range(board.length)]
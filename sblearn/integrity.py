@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+INTEGRITY_LEVELS = ("off", "incremental", "sampled", "full")
+
+
+class Violation(object):
+    """One broken invariant of the field, at a cell when x and y are given"""
+
+    def __init__(self, kind, message, x=None, y=None):
+        self.kind = kind
+        self.message = message
+        self.x = x
+        self.y = y
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return "Violation({0!r}, {1!r}, x={2}, y={3})".format(self.kind, self.message, self.x, self.y)
+
+
+class IntegrityReport(object):
+    """Violations found by one Field.integrity_check()
+
+    cells_checked is the number of cells looked at, the whole field for a
+    full check. Iterating the report yields its violations.
+    """
+
+    def __init__(self, epoch, level, cells_checked=0, violations=None):
+        self.epoch = epoch
+        self.level = level
+        self.cells_checked = cells_checked
+        self.violations = [] if violations is None else violations
+
+    def __len__(self):
+        return len(self.violations)
+
+    def __iter__(self):
+        return iter(self.violations)
+
+    @property
+    def ok(self):
+        return not self.violations
+
+    def by_kind(self):
+        counts = {}
+        for violation in self.violations:
+            counts[violation.kind] = counts.get(violation.kind, 0) + 1
+        return counts
+
+    def lines(self):
+        return [str(violation) for violation in self.violations]
@@ -1,17 +1,152 @@
 # -*- coding: utf-8 -*-
 
-import copy
+import multiprocessing
+import random
+import unittest
 
+import numpy as np
+
+# What the pool workers simulate, inherited through fork instead of pickled:
+# example fields hold lambdas and closures that do not pickle
+_simulation = None
+
+
+def _simulate(simulation, iteration, seed):
+    initial_field, check_stop_function, score_function, synchronous_training = simulation
+
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    field = initial_field.clone()
+    try:
+        for trainer in field.trainers():
+            trainer.synchronous = trainer.synchronous or synchronous_training
+            if seed is not None:
+                trainer.random_state = seed
 
-def run_simulation(initial_field, check_stop_function, score_function, times=5, verbose=False):
-    list_results = []
-    for iteration in range(times):
-        field = copy.deepcopy(initial_field)
         while not check_stop_function(field):
             field.make_time()
-        current_score = score_function(field)
-        list_results.append(current_score)
+
+        return iteration, seed, score_function(field)
+    finally:
+        field.close()
+
+
+def _simulate_in_worker(task):
+    return _simulate(_simulation, *task)
+
+
+def run_simulation(initial_field, check_stop_function, score_function, times=5, verbose=False,
+                   processes=1, seeds=None, callback=None, synchronous_training=True, return_seeds=False):
+    """Scores of `times` independent runs of initial_field, in the order of the runs
+
+    With return_seeds it returns (scores, seeds) instead, seeds being None
+    for unseeded serial runs.
+
+    With processes > 1 the runs are spread over a pool of forked processes
+    (so it needs a platform that forks). Each run then seeds random and
+    numpy.random with its own seed. The seeds are taken from `seeds`, or
+    drawn from the system when it is None. Serial runs are only seeded when
+    seeds are given. callback(iteration, seed, score) is called as every
+    run finishes, in the order they finish.
+
+    Model trainers of every run fit synchronously unless synchronous_training
+    is False, and seeded runs pass their seed to the trainers as random_state,
+    so a seed replays its run exactly.
+    """
+    global _simulation
+
+    if seeds is None and processes > 1:
+        system_random = random.SystemRandom()
+        seeds = [system_random.randint(0, 2 ** 32 - 1) for _ in range(times)]
+
+    if seeds is not None and len(seeds) != times:
+        raise ValueError("Expected {0} seeds, got {1}".format(times, len(seeds)))
+
+    tasks = [(iteration, None if seeds is None else seeds[iteration]) for iteration in range(times)]
+    list_results = [None] * times
+
+    def report(iteration, seed, current_score):
+        list_results[iteration] = current_score
         if verbose:
-            print "Iteration: {0}  Score: {1})".format(iteration+1, current_score)
+            if seed is None:
+                print "Iteration: {0}  Score: {1})".format(iteration+1, current_score)
+            else:
+                print "Iteration: {0}  Seed: {1}  Score: {2})".format(iteration+1, seed, current_score)
+        if callback is not None:
+            callback(iteration, seed, current_score)
+
+    if processes <= 1:
+        simulation = (initial_field, check_stop_function, score_function, synchronous_training)
+        for iteration, seed in tasks:
+            report(*_simulate(simulation, iteration, seed))
+        return (list_results, seeds) if return_seeds else list_results
+
+    _simulation = (initial_field, check_stop_function, score_function, synchronous_training)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_simulate_in_worker, tasks):
+            report(*result)
+    finally:
+        pool.terminate()
+        pool.join()
+        _simulation = None
+
+    return (list_results, seeds) if return_seeds else list_results
+
+
+class TestRunSimulation(unittest.TestCase):
+    def setUp(self):
+        import entities
+        from fixtures import build_field, creature
+
+        self.field = build_field(20, 12, [(3, 3, creature(True)), (15, 8, creature(False)),
+                                          (10, 2, creature(False)), (6, 9, entities.BreedingGround())])
+
+        def check_stop(f):
+            return f.epoch >= 40
+
+        def score(f):
+            return sorted((element.x, element.y) for element in f.find_all_entities_by_type(entities.Creature))
+
+        self.check_stop = check_stop
+        self.score = score
+
+    def test_seeded_runs_match(self):
+        seeds = [11, 12, 13]
+        serial, serial_seeds = run_simulation(self.field, self.check_stop, self.score, times=3, seeds=seeds,
+                                              return_seeds=True)
+        pooled, pooled_seeds = run_simulation(self.field, self.check_stop, self.score, times=3, seeds=seeds,
+                                              processes=2, return_seeds=True)
+
+        self.assertEqual(serial_seeds, seeds)
+        self.assertEqual(pooled_seeds, seeds)
+        self.assertEqual(serial, pooled)
+        self.assertNotEqual(serial[0], serial[1])
+
+    def test_drawn_seeds_are_returned(self):
+        pooled, seeds = run_simulation(self.field, self.check_stop, self.score, times=2, processes=2,
+                                       return_seeds=True)
+        replayed = run_simulation(self.field, self.check_stop, self.score, times=2, seeds=seeds)
+
+        self.assertEqual(len(seeds), 2)
+        self.assertEqual(pooled, replayed)
+
+    def test_unseeded_serial_runs(self):
+        scores, seeds = run_simulation(self.field, self.check_stop, self.score, times=1, return_seeds=True)
+
+        self.assertEqual(len(scores), 1)
+        self.assertTrue(seeds is None)
+
+    def test_scores_only_by_default(self):
+        reported = []
+        scores = run_simulation(self.field, self.check_stop, self.score, times=2, seeds=[5, 6],
+                                callback=lambda iteration, seed, score: reported.append((iteration, seed, score)))
+
+        self.assertEqual(len(scores), 2)
+        self.assertEqual(sorted(reported), [(0, 5, scores[0]), (1, 6, scores[1])])
+
 
-    return list_results
+if __name__ == '__main__':
+    unittest.main()
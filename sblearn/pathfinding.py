@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import random
+import unittest
+from collections import deque
+
+import numpy as np
+
+
+class WavePathfinder(object):
+    """Breadth-first wave over a fresh copy of the passability map"""
+
+    def __init__(self, board):
+        self.board = board
+
+    def find_path(self, x1, y1, x2, y2, max_expansions=None):
+        field_map = np.where(self.board.passability, None, -1).tolist()
+        self.wave(field_map, x1, y1, x2, y2)
+
+        return self.find_backwards(field_map, x2, y2)
+
+    @staticmethod
+    def wave(field_map, x1, y1, x2, y2):
+        current_wave_list = [(x1, y1)]
+        field_map[y1][x1] = 0
+
+        while len(current_wave_list) > 0 and field_map[y2][x2] is None:
+            next_wave_list = []
+            for coordinates in current_wave_list:
+                x, y = coordinates
+                wave_num = field_map[y][x] + 1
+
+                if (len(field_map) - 1 >= y + 1) and field_map[y + 1][x] is None:
+                    field_map[y + 1][x] = wave_num
+                    next_wave_list.append((x, y + 1))
+
+                if (y > 0) and field_map[y - 1][x] is None:
+                    field_map[y - 1][x] = wave_num
+                    next_wave_list.append((x, y - 1))
+
+                if (len(field_map[y]) - 1 >= x + 1) and field_map[y][x + 1] is None:
+                    field_map[y][x + 1] = wave_num
+                    next_wave_list.append((x + 1, y))
+
+                if (x > 0) and field_map[y][x - 1] is None:
+                    field_map[y][x - 1] = wave_num
+                    next_wave_list.append((x - 1, y))
+
+            current_wave_list = next_wave_list[:]
+
+    @staticmethod
+    def find_backwards(field_map, x2, y2):
+        num_steps = field_map[y2][x2]
+
+        if num_steps is None or num_steps == -1:
+            return None
+
+        path = [(x2, y2)]
+        num_steps -= 1
+
+        while num_steps > 0:
+
+            x, y = path[-1]
+
+            possible_steps = []
+
+            if (len(field_map) - 1 >= y + 1) and (field_map[y + 1][x] == num_steps):
+                possible_steps.append((x, y + 1))
+            elif (y > 0) and (field_map[y - 1][x] == num_steps):
+                possible_steps.append((x, y - 1))
+            elif (len(field_map[y]) - 1 >= x + 1) and (field_map[y][x + 1] == num_steps):
+                possible_steps.append((x + 1, y))
+            elif (x > 0) and (field_map[y][x - 1] == num_steps):
+                possible_steps.append((x - 1, y))
+
+            path.append(random.choice(possible_steps))
+
+            num_steps -= 1
+
+        path.reverse()
+
+        return path
+
+
+class AStarPathfinder(object):
+    """A* over the passability bitmap with a Manhattan heuristic and early exit
+
+    Costs and parents live in flat per-field buffers reused by every search.
+    An entry only counts when its stamp equals the current search generation,
+    so nothing has to be cleared or allocated between calls. Paths have the
+    same shape as WavePathfinder's: shortest, start excluded, goal included.
+    With max_expansions set the search gives up (returns None) after closing
+    that many cells.
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.generation = 0
+        self.__allocate()
+
+    def __allocate(self):
+        size = self.board.length * self.board.height
+
+        self.cost = [0] * size
+        self.parent = [0] * size
+        self.seen = [0] * size
+        self.closed = [0] * size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("cost", "parent", "seen", "closed"):
+            state[name] = None
+        return state
+
+    def find_path(self, x1, y1, x2, y2, max_expansions=None):
+        # Buffers are dropped on pickling and come back on the first search,
+        # the board may still be half restored while the pathfinder is
+        if self.cost is None:
+            self.__allocate()
+
+        length = self.board.length
+        height = self.board.height
+        passable = self.board.passability_flat
+
+        start = y1 * length + x1
+        goal = y2 * length + x2
+
+        if start == goal:
+            return [(x2, y2)]
+
+        self.generation += 1
+        generation = self.generation
+        cost = self.cost
+        parent = self.parent
+        seen = self.seen
+        closed = self.closed
+
+        seen[start] = generation
+        cost[start] = 0
+        queue = [(abs(x2 - x1) + abs(y2 - y1), 0, start)]
+        expansions = 0
+
+        while queue:
+            estimate, negative_cost, current = heapq.heappop(queue)
+
+            if closed[current] == generation:
+                continue
+            closed[current] = generation
+
+            expansions += 1
+            if max_expansions is not None and expansions > max_expansions:
+                return None
+
+            if current == goal:
+                return self.__walk_back(start, goal)
+
+            y, x = divmod(current, length)
+            next_cost = cost[current] + 1
+
+            for neighbour, nx, ny in ((current + length, x, y + 1), (current - length, x, y - 1),
+                                      (current + 1, x + 1, y), (current - 1, x - 1, y)):
+                if nx < 0 or ny < 0 or nx >= length or ny >= height or not passable[neighbour]:
+                    continue
+                if seen[neighbour] == generation and cost[neighbour] <= next_cost:
+                    continue
+
+                seen[neighbour] = generation
+                cost[neighbour] = next_cost
+                parent[neighbour] = current
+                heapq.heappush(queue, (next_cost + abs(x2 - nx) + abs(y2 - ny), -next_cost, neighbour))
+
+        return None
+
+    def __walk_back(self, start, goal):
+        length = self.board.length
+        path = []
+
+        current = goal
+        while current != start:
+            y, x = divmod(current, length)
+            path.append((x, y))
+            current = self.parent[current]
+
+        path.reverse()
+
+        return path
+
+
+class IncrementalPlanner(object):
+    """Keeps a path towards a moving goal up to date by repairing it
+
+    Instead of searching from scratch on every step, plan() takes the path the
+    agent is still following and:
+
+    - keeps it when the goal did not move and every cell is still passable;
+    - cuts it short when the new goal lies on it;
+    - extends it from the old goal when the goal moved at most reach cells;
+    - replaces a blocked stretch with a detour found by a search limited to
+      max_expansions cells, spliced in where the path is passable again;
+      loops left behind by splicing are cut out.
+
+    It falls back to board.make_path when none of that works or when the
+    repaired path grew longer than slack times the Manhattan distance plus
+    reach.
+    """
+
+    def __init__(self, reach=3, max_expansions=256, slack=2):
+        self.reach = reach
+        self.max_expansions = max_expansions
+        self.slack = slack
+
+        self.goal = None
+
+        self.reused = 0
+        self.repaired = 0
+        self.replanned = 0
+
+    def plan(self, board, x1, y1, x2, y2, path):
+        repaired = self.__repair(board, x1, y1, x2, y2, path)
+
+        if repaired and len(repaired) <= self.slack * (abs(x2 - x1) + abs(y2 - y1)) + self.reach:
+            self.goal = (x2, y2)
+            return repaired
+
+        self.replanned += 1
+        self.goal = (x2, y2)
+        return board.make_path(x1, y1, x2, y2)
+
+    def __repair(self, board, x1, y1, x2, y2, path):
+        if not path or self.goal is None or not board.cell_passable(x2, y2):
+            return None
+        if path[-1] != self.goal or abs(path[0][0] - x1) + abs(path[0][1] - y1) != 1:
+            return None
+
+        path = list(path)
+        changed = False
+
+        if (x2, y2) != self.goal:
+            if (x2, y2) in path:
+                path = path[:path.index((x2, y2)) + 1]
+            else:
+                old_x, old_y = self.goal
+                if abs(x2 - old_x) + abs(y2 - old_y) > self.reach:
+                    return None
+                extension = board.pathfinder.find_path(old_x, old_y, x2, y2, max_expansions=self.max_expansions)
+                if not extension:
+                    return None
+                path.extend(extension)
+            changed = True
+
+        index = 0
+        while index < len(path):
+            if board.cell_passable(*path[index]):
+                index += 1
+                continue
+
+            rejoin = index + 1
+            while rejoin < len(path) and not board.cell_passable(*path[rejoin]):
+                rejoin += 1
+            if rejoin == len(path):
+                return None
+
+            anchor_x, anchor_y = path[index - 1] if index > 0 else (x1, y1)
+            detour = board.pathfinder.find_path(anchor_x, anchor_y, path[rejoin][0], path[rejoin][1],
+                                                max_expansions=self.max_expansions)
+            if not detour:
+                return None
+
+            path = path[:index] + detour + path[rejoin + 1:]
+            index += len(detour)
+            changed = True
+
+        if changed:
+            self.repaired += 1
+            return self.__erase_loops((x1, y1), path)
+
+        self.reused += 1
+        return path
+
+    @staticmethod
+    def __erase_loops(start, path):
+        simple = []
+        positions = {start: -1}
+
+        for cell in path:
+            if cell in positions:
+                keep = positions[cell] + 1
+                for removed in simple[keep:]:
+                    del positions[removed]
+                del simple[keep:]
+            else:
+                positions[cell] = len(simple)
+                simple.append(cell)
+
+        return simple
+
+
+class DistanceField(object):
+    """Breadth-first distances over passable cells from many sources at once
+
+    distance[y, x] is the number of steps from (x, y) to the closest passable
+    source cell, -1 where no source can be reached. Every cell is queued at
+    most once, so building the field is linear in the number of cells.
+    """
+
+    def __init__(self, passable, sources):
+        height, length = passable.shape
+        open_cells = passable.ravel().tolist()
+        distance = [-1] * (length * height)
+
+        queue = deque()
+        for x, y in sources:
+            index = y * length + x
+            if open_cells[index] and distance[index] < 0:
+                distance[index] = 0
+                queue.append(index)
+
+        last_row = (height - 1) * length
+        while queue:
+            index = queue.popleft()
+            step = distance[index] + 1
+            x = index % length
+
+            if x > 0 and open_cells[index - 1] and distance[index - 1] < 0:
+                distance[index - 1] = step
+                queue.append(index - 1)
+            if x < length - 1 and open_cells[index + 1] and distance[index + 1] < 0:
+                distance[index + 1] = step
+                queue.append(index + 1)
+            if index >= length and open_cells[index - length] and distance[index - length] < 0:
+                distance[index - length] = step
+                queue.append(index - length)
+            if index < last_row and open_cells[index + length] and distance[index + length] < 0:
+                distance[index + length] = step
+                queue.append(index + length)
+
+        self.distance = np.array(distance, dtype=np.int32).reshape(height, length)
+
+    def __around(self, x, y):
+        height, length = self.distance.shape
+        for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+            if 0 <= nx < length and 0 <= ny < height and self.distance[ny, nx] >= 0:
+                yield nx, ny, self.distance[ny, nx]
+
+    def nearest_source(self, x, y):
+        best = None
+        for nx, ny, distance in self.__around(x, y):
+            if best is None or distance < best[2]:
+                best = (nx, ny, distance)
+
+        if best is None:
+            return None
+
+        x, y, distance = best
+        while distance > 0:
+            for nx, ny, next_distance in self.__around(x, y):
+                if next_distance == distance - 1:
+                    x, y, distance = nx, ny, next_distance
+                    break
+
+        return x, y
+
+
+class BucketIndex(object):
+    """Items at grid points, hashed into square buckets of bucket_size cells"""
+
+    def __init__(self, items, bucket_size=8):
+        self.bucket_size = bucket_size
+        self.buckets = {}
+        self.size = 0
+
+        for x, y, item in items:
+            self.buckets.setdefault((x // bucket_size, y // bucket_size), []).append((x, y, item))
+            self.size += 1
+
+        # Span of the occupied buckets, nothing outside it is worth looking at
+        self.bounds = None
+        if self.buckets:
+            self.bounds = (min(bx for bx, by in self.buckets), max(bx for bx, by in self.buckets),
+                           min(by for bx, by in self.buckets), max(by for bx, by in self.buckets))
+
+    def __len__(self):
+        return self.size
+
+    def within(self, x, y, radius):
+        """Items no further than radius steps from (x, y) in Manhattan distance"""
+        if self.bounds is None:
+            return []
+
+        size = self.bucket_size
+        min_bx, max_bx, min_by, max_by = self.bounds
+        x_start, x_stop = max((x - radius) // size, min_bx), min((x + radius) // size, max_bx)
+        y_start, y_stop = max((y - radius) // size, min_by), min((y + radius) // size, max_by)
+
+        if (x_stop - x_start + 1) * (y_stop - y_start + 1) > len(self.buckets):
+            keys = [(bx, by) for bx, by in self.buckets if x_start <= bx <= x_stop and y_start <= by <= y_stop]
+        else:
+            keys = [(bx, by) for bx in range(x_start, x_stop + 1) for by in range(y_start, y_stop + 1)]
+
+        found = []
+        for key in keys:
+            for item_x, item_y, item in self.buckets.get(key, ()):
+                if abs(item_x - x) + abs(item_y - y) <= radius:
+                    found.append(item)
+        return found
+
+
+class PathCache(object):
+    """Paths by (start, goal), checked against the field's passability version
+
+    Every stored path is also registered for each cell along it, so an agent
+    walking its own path finds the rest of it under its new start. A route
+    found while the passability version is still the one it was computed at
+    is returned as is. When cells were only closed since, it is re-checked
+    cell by cell and reused if it is still walkable. Once any cell has opened
+    (the field's opened_version changed) a shorter way may exist, so the
+    route is searched again; on fields where agents keep moving that is most
+    of the time, and the cache mostly serves the epoch a route was found in.
+    Failed searches are only trusted while the version is unchanged. Callers
+    get a copy they are free to consume.
+    """
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.routes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def find_path(self, board, x1, y1, x2, y2):
+        version = board.passability_version
+        opened = board.opened_version
+        key = (x1, y1, x2, y2)
+
+        route = self.routes.get(key)
+        if route is not None:
+            record, index = route
+            if record[1] == version or (record[2] == opened and self.__still_walkable(board, record, index)):
+                record[1] = version
+                self.hits += 1
+                if record[0] is None:
+                    return None
+                return record[0][index:]
+
+            self.invalidations += 1
+
+        self.misses += 1
+
+        path = board.pathfinder.find_path(x1, y1, x2, y2)
+        self.__store(key, path, version, opened)
+
+        if path is None:
+            return None
+        return list(path)
+
+    @staticmethod
+    def __still_walkable(board, record, index):
+        path = record[0]
+        if path is None:
+            return False
+
+        passable = board.passability_flat
+        length = board.length
+        for x, y in path[index:]:
+            if not passable[y * length + x]:
+                return False
+        return True
+
+    def __store(self, key, path, version, opened):
+        if len(self.routes) >= self.max_entries:
+            self.routes = {}
+
+        record = [path, version, opened]
+        self.routes[key] = (record, 0)
+
+        if path is not None:
+            x2, y2 = key[2], key[3]
+            for index, (x, y) in enumerate(path[:-1]):
+                self.routes[(x, y, x2, y2)] = (record, index + 1)
+
+    def clear(self):
+        self.routes = {}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                "entries": len(self.routes)}
+
+
+PATHFINDERS = {"astar": AStarPathfinder,
+               "wave": WavePathfinder}
+
+
+class TestPathCache(unittest.TestCase):
+    def setUp(self):
+        import entities
+        from fixtures import Harvesters, build_field
+
+        # A creature stands in the middle of the straight way between the ends of the field
+        self.blocker = entities.Creature()
+        self.field = build_field(12, 5, [(5, 1, self.blocker)], demiurge=Harvesters(plan=None))
+        self.cache = self.field.path_cache
+
+    def test_reused_while_cells_only_close(self):
+        import entities
+
+        self.assertEqual(len(self.field.make_path(1, 1, 10, 1)), 11)
+
+        self.field.insert_object(8, 3, entities.Block())
+        hits = self.cache.hits
+
+        self.assertEqual(len(self.field.make_path(1, 1, 10, 1)), 11)
+        self.assertEqual(self.cache.hits, hits + 1)
+
+    def test_searched_again_after_a_cell_opens(self):
+        self.assertEqual(len(self.field.make_path(1, 1, 10, 1)), 11)
+
+        self.field.remove_object(self.blocker)
+
+        self.assertEqual(len(self.field.make_path(1, 1, 10, 1)), 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+class PopulationHistory(object):
+    """Field.get_stats() and Field.get_totals() of every recorded epoch
+
+    Every name is a column with one value per record() call. A class that
+    shows up later than the first record counts zero in the rows before.
+    Both getters are kept up to date by the field, so a record costs about
+    as much as the number of classes.
+    """
+
+    def __init__(self):
+        self.epochs = []
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def record(self, field):
+        row = field.get_stats()
+        row.update(field.get_totals())
+
+        for name in row:
+            if name not in self.columns:
+                self.columns[name] = [0] * len(self.epochs)
+        for name, column in self.columns.iteritems():
+            column.append(row.get(name, 0))
+
+        self.epochs.append(field.epoch)
+
+    def series(self, name):
+        """Values of one column as an array aligned with epochs"""
+        return np.array(self.columns.get(name, [0] * len(self.epochs)), dtype=np.int64)
+
+    def as_arrays(self):
+        return np.array(self.epochs, dtype=np.int64), dict((name, self.series(name)) for name in self.columns)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+
+import numpy as np
+
+import entities
+
+
+def render_frame(field, frame, code_of):
+    """Fills frame, a (height, length) array, with code_of(colour) of the top element of every cell"""
+    layers = field.layers
+
+    if layers is None:
+        for y in range(field.height):
+            for x in range(field.length):
+                frame[y, x] = code_of(field.get_top(x, y).color)
+        return
+
+    frame[:] = code_of(entities.Blank.color_empty)
+    frame[layers.substance > 0] = code_of(entities.Blank.color_full)
+    frame[layers.base == layers.block_code] = code_of(entities.Block().color)
+    for (x, y), stack in layers.stacks.iteritems():
+        frame[y, x] = code_of(stack[-1].color)
+
+
+class FrameRecorder(object):
+    """Records what the renderer would show, one frame per call to record()
+
+    A frame holds, for every cell, the palette index of the colour of its
+    top element (the element list_obj_representation hands to the
+    renderer). Frames go into a uint8 array of shape (frames, height,
+    length) that is preallocated and memory-mapped from `filename`, a .npy
+    file. With chunk_frames set, frames are collected into chunks of that
+    many frames instead, and each chunk is appended to `filename` compressed
+    with zlib. The index goes to filename + ".jsonl", one JSON object per
+    line appended as the recording grows: the size of the field first, then
+    every new palette colour, the epoch and population stats of every frame
+    and the offset, size and frame count of every chunk.
+    """
+
+    def __init__(self, filename, length, height, frames, chunk_frames=None):
+        self.filename = filename
+        self.length = length
+        self.height = height
+        self.frames = frames
+        self.chunk_frames = chunk_frames
+
+        self.palette = []
+        self.__palette_index = {}
+
+        self.epochs = []
+        self.stats = []
+        self.chunks = []
+
+        if chunk_frames is None:
+            self.__frames = np.lib.format.open_memmap(filename, mode="w+", dtype=np.uint8,
+                                                      shape=(frames, height, length))
+        else:
+            self.__frames = np.zeros((chunk_frames, height, length), dtype=np.uint8)
+            self.__chunk_file = open(filename, "wb")
+            self.__chunk_offset = 0
+
+        self.__index = open(filename + ".jsonl", "w")
+        self.__append({"length": length, "height": height, "chunk_frames": chunk_frames})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def code_of(self, color):
+        if color not in self.__palette_index:
+            if len(self.palette) > np.iinfo(np.uint8).max:
+                raise ValueError("More than 256 colours in one recording")
+            self.__palette_index[color] = len(self.palette)
+            self.palette.append(color)
+            self.__append({"color": color})
+        return self.__palette_index[color]
+
+    def record(self, field):
+        if len(self.epochs) >= self.frames:
+            raise ValueError("The recording is full ({0} frames)".format(self.frames))
+        if (field.length, field.height) != (self.length, self.height):
+            raise ValueError("Expected a {0}x{1} field".format(self.length, self.height))
+
+        if self.chunk_frames is None:
+            render_frame(field, self.__frames[len(self.epochs)], self.code_of)
+        else:
+            render_frame(field, self.__frames[len(self.epochs) % self.chunk_frames], self.code_of)
+
+        self.epochs.append(field.epoch)
+        self.stats.append(field.get_stats())
+        self.__append({"epoch": field.epoch, "stats": self.stats[-1]})
+
+        if self.chunk_frames is not None and len(self.epochs) % self.chunk_frames == 0:
+            self.__write_chunk(self.chunk_frames)
+
+    def __write_chunk(self, frames):
+        data = zlib.compress(self.__frames[:frames].tobytes())
+        self.__chunk_file.write(data)
+        self.chunks.append((self.__chunk_offset, len(data), frames))
+        self.__chunk_offset += len(data)
+        self.__append({"chunk": self.chunks[-1]})
+        self.flush()
+
+    def __append(self, entry):
+        self.__index.write(json.dumps(entry) + "\n")
+
+    def flush(self):
+        """Writes out the frames and index entries recorded so far"""
+        if self.chunk_frames is None:
+            self.__frames.flush()
+        else:
+            self.__chunk_file.flush()
+        self.__index.flush()
+
+    def close(self):
+        if self.__index.closed:
+            return
+
+        if self.chunk_frames is not None:
+            pending = len(self.epochs) % self.chunk_frames
+            if pending:
+                self.__write_chunk(pending)
+        self.flush()
+
+        if self.chunk_frames is not None:
+            self.__chunk_file.close()
+        self.__index.close()
+
+
+class FrameFile(object):
+    """Frames of a recording, read on demand
+
+    Uncompressed recordings are memory-mapped, so any frame is available
+    at once. Compressed ones decompress the chunk of the frame asked for
+    and keep the last chunk around for neighbouring frames. A last index
+    line cut short, by a crash while recording, is ignored.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.palette = []
+        self.epochs = []
+        self.stats = []
+        self.chunks = []
+
+        with open(filename + ".jsonl") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                if "length" in entry:
+                    self.length = entry["length"]
+                    self.height = entry["height"]
+                    self.chunk_frames = entry["chunk_frames"]
+                elif "color" in entry:
+                    self.palette.append(str(entry["color"]))
+                elif "epoch" in entry:
+                    self.epochs.append(entry["epoch"])
+                    self.stats.append(entry["stats"])
+                else:
+                    self.chunks.append(entry["chunk"])
+
+        if self.chunk_frames is not None:
+            # Frames of a chunk that never made it to the file are not readable
+            del self.epochs[len(self.chunks) * self.chunk_frames:]
+            del self.stats[len(self.chunks) * self.chunk_frames:]
+
+        self.__chunk = (None, None)
+        if self.chunk_frames is None:
+            self.__frames = np.load(filename, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def frame(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError("Frame {0} is not in the recording".format(index))
+
+        if self.chunk_frames is None:
+            return self.__frames[index]
+
+        number = index // self.chunk_frames
+        if self.__chunk[0] != number:
+            offset, size, frames = self.chunks[number]
+            with open(self.filename, "rb") as f:
+                f.seek(offset)
+                data = zlib.decompress(f.read(size))
+            self.__chunk = (number, np.frombuffer(data, dtype=np.uint8).reshape(frames, self.height, self.length))
+
+        return self.__chunk[1][index % self.chunk_frames]
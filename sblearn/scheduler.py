@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+
+
+class EventScheduler(object):
+    """Priority queue of the epochs at which entities next need to live
+
+    Entries are ordered by (epoch, y, x, serial) so that entities due in the
+    same epoch wake up in the row-major order a full scan would visit them.
+    Rescheduling does not remove the old heap entry, it is skipped on pop
+    because wake_ups no longer points at its epoch.
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.wake_ups = {}
+        self.__serial = 0
+
+    def schedule(self, entity_object, epoch):
+        if epoch is None:
+            self.cancel(entity_object)
+            return
+
+        if self.wake_ups.get(entity_object) == epoch:
+            return
+
+        self.wake_ups[entity_object] = epoch
+        self.__serial += 1
+        heapq.heappush(self.queue, (epoch, entity_object.y, entity_object.x, self.__serial, entity_object))
+
+    def cancel(self, entity_object):
+        self.wake_ups.pop(entity_object, None)
+
+    def sleeping(self, entity_object):
+        wake_up = self.wake_ups.get(entity_object)
+        return wake_up is None or wake_up > entity_object.z
+
+    def pop_due(self, epoch):
+        while self.queue and self.queue[0][0] <= epoch:
+            wake_up, y, x, serial, entity_object = heapq.heappop(self.queue)
+
+            if self.wake_ups.get(entity_object) != wake_up:
+                continue
+
+            del self.wake_ups[entity_object]
+            yield entity_object
+
+    def __len__(self):
+        return len(self.wake_ups)
+
+
+SCHEDULERS = ("scan", "events")
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+import json
+import mmap
+import numbers
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+import entities
+import substances
+from pathfinding import PATHFINDERS
+
+MAGIC = "SBLSNAP\x00"
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 64
+
+BASE_BLANK = 0
+BASE_BLOCK = 1
+
+ENTITY_COLUMNS = ("x", "y", "z", "age", "alive", "time_of_death", "sex", "substance")
+COLUMN_TYPES = {"type": np.int16, "x": np.int32, "y": np.int32, "z": np.int64, "age": np.int64,
+                "alive": np.uint8, "time_of_death": np.int64, "sex": np.int8, "substance": np.int32,
+                "model": np.int16, "entity": np.int32, "duration": np.int64, "timing": np.int64}
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def qualified_name(cls):
+    return "{0}.{1}".format(cls.__module__, cls.__name__)
+
+
+def resolve(name):
+    module_name, class_name = str(name).rsplit(".", 1)
+    module = __import__(module_name, fromlist=[class_name])
+    return getattr(module, class_name)
+
+
+def model_state(model):
+    """Constructor parameters and fitted attributes of an sklearn style model"""
+    params = {}
+    for name, value in model.get_params().iteritems():
+        if value is None or isinstance(value, (basestring, bool, numbers.Number)):
+            params[name] = value
+
+    fitted = {}
+    for name, value in vars(model).iteritems():
+        if name.startswith("_") or not name.endswith("_"):
+            continue
+        if isinstance(value, np.ndarray) and value.dtype.kind in "biuf":
+            fitted[name] = value
+        elif isinstance(value, (bool, numbers.Number)):
+            fitted[name] = value
+
+    return params, fitted
+
+
+def entity_record(element):
+    """Values of ENTITY_COLUMNS for an element and its states as (state type, duration, timing)"""
+    values = (element.x,
+              element.y,
+              element.z,
+              element.age,
+              int(element.alive),
+              -1 if element.time_of_death is None else element.time_of_death,
+              -1 if getattr(element, "sex", None) is None else int(element.sex),
+              element.count_substance_of_type(substances.Substance))
+    element_states = tuple((type(state), state.duration, -1 if state.timing is None else state.timing)
+                           for state in element._states_list)
+    return values, element_states
+
+
+def element_model(element):
+    if isinstance(element, entities.Agent):
+        return element.decision_model()
+    return None
+
+
+def write_snapshot(field, filename):
+    """Writes the field as a snapshot file
+
+    Layout: MAGIC, version and header length as two little-endian uint32,
+    a JSON header, then every array as raw bytes at an offset (relative to
+    the end of the header, aligned to ALIGNMENT) listed in the header.
+
+    Grid layers: base (BASE_BLANK or BASE_BLOCK for the bottom scenery of a
+    cell), substance (substances in that scenery), passable and top (type of
+    the top element, an index into the header's types). Every other element
+    is a row of the entity tables, in row-major and then stacking order;
+    their states are rows of the state tables. Decision models are stored
+    as constructor parameters plus fitted arrays and numbers, entities
+    refer to them by index.
+    """
+    header, arrays, stacked, models = capture_snapshot(field)
+    write_snapshot_file(filename, header, arrays)
+
+
+def capture_snapshot(field):
+    """Header (without the array list), arrays, entities in row order and models of a snapshot of the field
+
+    Arrays are copies, so they can be written out while the field moves on.
+    """
+    length = field.length
+    height = field.height
+
+    types = []
+    type_index = {}
+
+    def code_of(cls):
+        if cls not in type_index:
+            type_index[cls] = len(types)
+            types.append(qualified_name(cls))
+        return type_index[cls]
+
+    state_types = []
+    state_index = {}
+
+    models = []
+    model_index = {}
+
+    base = np.zeros((height, length), dtype=np.uint8)
+    substance = np.zeros((height, length), dtype=np.int32)
+    top = np.zeros((height, length), dtype=np.int16)
+    stacked = []
+
+    layers = field.layers
+    if layers is not None:
+        base[layers.base == layers.block_code] = BASE_BLOCK
+        substance[:] = layers.substance
+        codes = np.array([code_of(cls) for cls in layers.types], dtype=np.int16)
+        top[:] = codes[layers.type_code]
+        for x, y in sorted(layers.stacks, key=lambda coordinates: (coordinates[1], coordinates[0])):
+            stacked.extend(layers.stacks[(x, y)])
+    else:
+        for y in range(height):
+            for x in range(length):
+                cell = field.get_cell(x, y)
+                bottom = cell[0]
+                if type(bottom) in (entities.Blank, entities.Block):
+                    base[y, x] = BASE_BLOCK if type(bottom) is entities.Block else BASE_BLANK
+                    substance[y, x] = bottom.count_substance_of_type(substances.Substance)
+                    stacked.extend(cell[1:])
+                else:
+                    stacked.extend(cell)
+                top[y, x] = code_of(type(cell[-1]))
+
+    columns = dict((name, []) for name in ENTITY_COLUMNS + ("type", "model"))
+    state_columns = dict((name, []) for name in ("entity", "type", "duration", "timing"))
+
+    for row, element in enumerate(stacked):
+        model = element_model(element)
+        if model is not None and id(model) not in model_index:
+            model_index[id(model)] = len(models)
+            models.append(model)
+
+        values, element_states = entity_record(element)
+        for name, value in zip(ENTITY_COLUMNS, values):
+            columns[name].append(value)
+        columns["type"].append(code_of(type(element)))
+        columns["model"].append(-1 if model is None else model_index[id(model)])
+
+        for state_type, duration, timing in element_states:
+            if state_type not in state_index:
+                state_index[state_type] = len(state_types)
+                state_types.append(qualified_name(state_type))
+            state_columns["entity"].append(row)
+            state_columns["type"].append(state_index[state_type])
+            state_columns["duration"].append(duration)
+            state_columns["timing"].append(timing)
+
+    arrays = [("base", base), ("substance", substance), ("top", top),
+              ("passable", field.passability.astype(np.uint8))]
+    arrays.extend(("entities." + name, np.array(values, dtype=COLUMN_TYPES[name]))
+                  for name, values in sorted(columns.iteritems()))
+    arrays.extend(("states." + name, np.array(values, dtype=COLUMN_TYPES[name]))
+                  for name, values in sorted(state_columns.iteritems()))
+
+    pathfinder = None
+    for name, cls in PATHFINDERS.iteritems():
+        if type(field.pathfinder) is cls:
+            pathfinder = name
+
+    model_headers = []
+    for number, model in enumerate(models):
+        model_header, model_arrays = model_record(model)
+        arrays.extend(("model{0}.{1}".format(number, name), value) for name, value in model_arrays)
+        model_headers.append(model_header)
+
+    header = {"epoch": field.epoch,
+              "length": length,
+              "height": height,
+              "storage": field.storage_type,
+              "scheduler": field.scheduler_type,
+              "pathfinder": pathfinder,
+              "types": types,
+              "state_types": state_types,
+              "models": model_headers}
+
+    return header, arrays, stacked, models
+
+
+def model_record(model):
+    """Header entry of a model and copies of its fitted arrays as (name, array)"""
+    params, fitted = model_state(model)
+    model_header = {"class": qualified_name(type(model)), "params": params, "fitted": {}, "arrays": []}
+    model_arrays = []
+    for name, value in sorted(fitted.iteritems()):
+        if isinstance(value, np.ndarray):
+            model_arrays.append((name, np.array(value)))
+            model_header["arrays"].append(name)
+        else:
+            model_header["fitted"][name] = value.item() if isinstance(value, np.generic) else value
+    return model_header, model_arrays
+
+
+def restore_fitted(model, model_header, model_arrays):
+    for name, value in model_header["fitted"].iteritems():
+        setattr(model, str(name), value)
+    for name, value in model_arrays:
+        setattr(model, str(name), np.array(value))
+
+
+def build_model(model_header, model_arrays):
+    model = resolve(model_header["class"])(**dict((str(name), value)
+                                                  for name, value in model_header["params"].iteritems()))
+    restore_fitted(model, model_header, model_arrays)
+    return model
+
+
+def write_snapshot_file(filename, header, arrays):
+    array_headers = {}
+    offset = 0
+    for name, array in arrays:
+        array_headers[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = aligned(offset + array.nbytes)
+
+    header = json.dumps(dict(header, arrays=array_headers))
+
+    with open(filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+
+        data_start = aligned(f.tell())
+        for name, array in arrays:
+            f.seek(data_start + array_headers[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+class Snapshot(object):
+    """Read-only view of a snapshot file
+
+    The file is memory-mapped: opening only parses the header and arrays
+    are views into the mapping made on first access, so just the pages
+    that are actually read come from disk. Arrays stay valid until close().
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__file = open(filename, "rb")
+        try:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.__file.close()
+            raise
+
+        if self.__map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("{0} is not a field snapshot".format(filename))
+
+        version, header_length = struct.unpack_from("<II", self.__map, len(MAGIC))
+        if version > SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError("Snapshot version {0} is newer than supported {1}".format(version, SNAPSHOT_VERSION))
+
+        header_start = len(MAGIC) + 8
+        self.version = version
+        self.header = json.loads(self.__map[header_start:header_start + header_length])
+        self.__data_start = aligned(header_start + header_length)
+        self.__arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.__arrays = {}
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        self.__file.close()
+
+    @property
+    def epoch(self):
+        return self.header["epoch"]
+
+    @property
+    def length(self):
+        return self.header["length"]
+
+    @property
+    def height(self):
+        return self.header["height"]
+
+    def array(self, name):
+        if name not in self.__arrays:
+            spec = self.header["arrays"][name]
+            dtype = np.dtype(str(spec["dtype"]))
+            count = int(np.prod(spec["shape"]))
+            if count == 0:
+                array = np.zeros(spec["shape"], dtype=dtype)
+            else:
+                array = np.frombuffer(self.__map, dtype=dtype, count=count,
+                                      offset=self.__data_start + spec["offset"]).reshape(spec["shape"])
+            self.__arrays[name] = array
+        return self.__arrays[name]
+
+    def entity_column(self, name):
+        return self.array("entities." + name)
+
+    def state_column(self, name):
+        return self.array("states." + name)
+
+    def model(self, number):
+        """A new model equal to the stored one"""
+        model_header = self.header["models"][number]
+        return build_model(model_header, [(name, self.array("model{0}.{1}".format(number, name)))
+                                          for name in model_header["arrays"]])
+
+    def restore_model(self, number, model):
+        """Copies the fitted attributes of a stored model into model"""
+        model_header = self.header["models"][number]
+        restore_fitted(model, model_header, [(name, self.array("model{0}.{1}".format(number, name)))
+                                             for name in model_header["arrays"]])
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        from fixtures import Harvesters, build_field, creature
+
+        self.keeper = lambda: Harvesters(plan=None)
+        layout = [(6, y, entities.Block()) for y in range(2, 8)]
+        layout.extend([(2, 2, creature(True)), (12, 7, creature(False)),
+                       (9, 4, entities.BreedingGround()), (9, 4, creature(True))])
+        self.field = build_field(16, 10, layout, demiurge=self.keeper())
+        for _ in range(3):
+            self.field.make_time()
+        self.field.demiurge.public_decision_model.fit([[0., 0.], [1., 1.], [0., 1.]], [0, 1, 1])
+
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "field.snap")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cells(self, f):
+        # Ages of the scenery are not stored
+        return [[(type(element).__name__, element.z, None if index == 0 else element.age,
+                  getattr(element, "sex", None), element.count_substance_of_type(substances.Substance))
+                 for index, element in enumerate(f.get_cell(x, y))]
+                for y in range(f.height) for x in range(f.length)]
+
+    def test_round_trip(self):
+        import field
+
+        self.field.save_snapshot(self.filename)
+
+        with field.load_snapshot(self.filename) as snapshot:
+            self.assertEqual(snapshot.epoch, self.field.epoch)
+            restored = field.Field.from_snapshot(snapshot, self.keeper())
+
+        self.assertEqual(restored.epoch, self.field.epoch)
+        self.assertEqual(restored.get_stats(), self.field.get_stats())
+        self.assertEqual(self.cells(restored), self.cells(self.field))
+        self.assertTrue(restored.integrity_check("full").ok)
+
+        model = self.field.demiurge.public_decision_model
+        restored_model = restored.demiurge.public_decision_model
+        self.assertFalse(restored_model is model)
+        self.assertTrue(np.array_equal(restored_model.coef_, model.coef_))
+        self.assertTrue(np.array_equal(restored_model.intercept_, model.intercept_))
+        self.assertEqual(restored_model.predict([[0., 0.], [1., 1.]]).tolist(),
+                         model.predict([[0., 0.], [1., 1.]]).tolist())
+
+        restored.make_time()
+        self.assertEqual(restored.epoch, self.field.epoch + 1)
+
+    def test_not_a_snapshot(self):
+        with open(self.filename, "wb") as f:
+            f.write("not a snapshot at all")
+
+        self.assertRaises(ValueError, Snapshot, self.filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,19 @@ class State(object):
     def __init__(self, subject):
         self.subject = subject
         self.duration = 0
+        self.timing = None
 
     def affect(self):
         self.duration += 1
 
+    def ticks_to_timing(self):
+        if self.timing is None or self.duration >= self.timing:
+            return None
+        return self.timing - self.duration
+
+    def catch_up(self, ticks):
+        self.duration += ticks
+
 
 class Pregnant(State):
     def __init__(self, subject):
@@ -0,0 +1,833 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import math
+
+import numpy as np
+
+import entities
+import substances
+from integrity import Violation
+
+# Neighbour order matches the historical probing order: y + 1, y - 1, x + 1, x - 1.
+# The neighbour at offset i sees the cell back through offset i ^ 1.
+NEIGHBOUR_OFFSETS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+NEIGHBOUR_LISTS = [tuple(offset for bit, offset in enumerate(NEIGHBOUR_OFFSETS) if mask & (1 << bit))
+                   for mask in range(1 << len(NEIGHBOUR_OFFSETS))]
+
+
+def bernoulli_successes(number, probability):
+    """Sorted indices of the successes among `number` independent Bernoulli trials
+
+    Gaps between successes are geometric, so only about number * probability
+    values are drawn instead of one per trial.
+    """
+    if number <= 0 or probability <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    expected = number * probability
+    size = int(expected + 5 * math.sqrt(expected)) + 16
+
+    positions = np.cumsum(np.random.geometric(probability, size=size)) - 1
+    while positions[-1] < number:
+        more = np.cumsum(np.random.geometric(probability, size=size)) + positions[-1]
+        positions = np.concatenate((positions, more))
+
+    return positions[:np.searchsorted(positions, number)]
+
+
+def neighbour_masks(passable):
+    passable = passable.astype(np.uint8)
+    masks = np.zeros(passable.shape, dtype=np.uint8)
+
+    masks[:-1, :] |= passable[1:, :]
+    masks[1:, :] |= passable[:-1, :] << 1
+    masks[:, :-1] |= passable[:, 1:] << 2
+    masks[:, 1:] |= passable[:, :-1] << 3
+
+    return masks
+
+
+class GridStorage(object):
+    """Passability bitmap, neighbour masks and type index kept up to date on every change
+
+    Bit i of free_neighbours[y, x] is set when the cell at NEIGHBOUR_OFFSETS[i]
+    from (x, y) lies inside the field and is passable. passable_flat mirrors
+    the bitmap as a row-major bytearray for fast scalar reads in hot loops.
+    passability_version grows by one every time a cell changes passability,
+    opened_version only when a cell becomes passable.
+
+    by_type maps every entity class to {entity: serial} for the entities of
+    exactly that class stored as objects, holders maps a substance type to
+    the set of those entities whose container holds it. The serial records
+    insertion order, so query results come back in the same row-major, bottom
+    to top order a full scan would produce. locations maps every stored
+    entity to the (x, y) of its cell.
+
+    While touched is a set, the coordinates of every cell whose entities,
+    passability or substances change are added to it.
+
+    Population counters follow the same updates: living and dead hold the
+    stored entities that are alive and the dead bodies still lying around,
+    held maps every entity holding substances to its count per substance
+    type and substance_totals sums those counts over the field.
+    """
+
+    def _init_passability(self, passable):
+        self.passable = passable
+        self.passable_flat = bytearray(passable.astype(np.uint8).tobytes())
+        self.free_neighbours = neighbour_masks(passable)
+        self.passability_version = 0
+        self.opened_version = 0
+
+    def cell_passable(self, x, y):
+        return self.passable[y, x]
+
+    def passable_rows(self):
+        return self.passable.tolist()
+
+    def free_cells_around(self, x, y):
+        return [(x + dx, y + dy) for dx, dy in NEIGHBOUR_LISTS[self.free_neighbours[y, x]]]
+
+    def _set_passable(self, x, y, passable):
+        if self.passable[y, x] == passable:
+            return
+
+        self.passable[y, x] = passable
+        self.passable_flat[y * self.length + x] = 1 if passable else 0
+        self.passability_version += 1
+        if passable:
+            self.opened_version += 1
+
+        for bit, (dx, dy) in enumerate(NEIGHBOUR_OFFSETS):
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.length and 0 <= ny < self.height:
+                if passable:
+                    self.free_neighbours[ny, nx] |= 1 << (bit ^ 1)
+                else:
+                    self.free_neighbours[ny, nx] &= ~(1 << (bit ^ 1)) & 0xFF
+
+    def _init_index(self):
+        self.by_type = {}
+        self.holders = {}
+        self.locations = {}
+        self.touched = None
+        self.living = set()
+        self.dead = set()
+        self.held = {}
+        self.substance_totals = {}
+        self.__serial = 0
+
+    def track_touched(self, enabled):
+        self.touched = set() if enabled else None
+
+    def take_touched(self):
+        """Cells touched since the previous call, starts tracking if it was off"""
+        touched = self.touched
+        self.touched = set()
+        return set() if touched is None else touched
+
+    def _index(self, entity_object, x, y):
+        self.locations[entity_object] = (x, y)
+        if self.touched is not None:
+            self.touched.add((x, y))
+        self.__serial += 1
+        self.by_type.setdefault(type(entity_object), {})[entity_object] = self.__serial
+        self.update_holder(entity_object)
+        self.update_life(entity_object)
+
+    def _unindex(self, entity_object):
+        coordinates = self.locations.pop(entity_object, None)
+        if self.touched is not None and coordinates is not None:
+            self.touched.add(coordinates)
+        self.by_type.get(type(entity_object), {}).pop(entity_object, None)
+        for entity_holders in self.holders.itervalues():
+            entity_holders.discard(entity_object)
+        self.living.discard(entity_object)
+        self.dead.discard(entity_object)
+        self._add_substance_totals(self.held.pop(entity_object, {}), -1)
+
+    def indexed(self, entity_object):
+        return entity_object in self.locations
+
+    def locate(self, entity_object):
+        return self.locations.get(entity_object)
+
+    def update_holder(self, entity_object):
+        if not self.indexed(entity_object):
+            return
+
+        if self.touched is not None:
+            self.touched.add(self.locations[entity_object])
+
+        held_types = entity_object.substance_types()
+
+        for substance_type, entity_holders in self.holders.iteritems():
+            if substance_type not in held_types:
+                entity_holders.discard(entity_object)
+        for substance_type in held_types:
+            self.holders.setdefault(substance_type, set()).add(entity_object)
+
+        self._add_substance_totals(self.held.pop(entity_object, {}), -1)
+        counts = dict((substance_type, entity_object.count_substance_of_type(substance_type))
+                      for substance_type in held_types)
+        if counts:
+            self.held[entity_object] = counts
+        self._add_substance_totals(counts, 1)
+
+    def _add_substance_totals(self, counts, sign):
+        for substance_type, number in counts.iteritems():
+            self.substance_totals[substance_type] = self.substance_totals.get(substance_type, 0) + sign * number
+
+    def update_life(self, entity_object):
+        if not self.indexed(entity_object):
+            return
+
+        if entity_object.alive:
+            self.living.add(entity_object)
+            self.dead.discard(entity_object)
+        elif entity_object.time_of_death is not None:
+            self.living.discard(entity_object)
+            self.dead.add(entity_object)
+        else:
+            self.living.discard(entity_object)
+            self.dead.discard(entity_object)
+
+    def _count_indexed(self, stats):
+        for entity_type, entities_of_type in self.by_type.iteritems():
+            if entities_of_type:
+                class_name = entity_type.class_name()
+                stats[class_name] = stats.get(class_name, 0) + len(entities_of_type)
+        return stats
+
+    def totals(self):
+        found = {"Alive": len(self.living), "Dead": len(self.dead)}
+        for substance_type, number in self.substance_totals.iteritems():
+            if number:
+                found[substance_type.__name__] = number
+        return found
+
+    def _indexed_of_type(self, type_to_find):
+        found = []
+        for entity_type, entities_of_type in self.by_type.iteritems():
+            if issubclass(entity_type, type_to_find):
+                found.extend(entities_of_type.iteritems())
+        return found
+
+    def entities_of_type(self, type_to_find):
+        found = self._indexed_of_type(type_to_find)
+        found.sort(key=lambda item: (item[0].y, item[0].x, item[1]))
+        return [entity_object for entity_object, serial in found]
+
+    def _coordinates_of_type(self, type_to_find):
+        found = set((entity_object.x, entity_object.y) for entity_object, serial in self._indexed_of_type(type_to_find))
+        found.update((entity_object.x, entity_object.y) for entity_object in self.holders.get(type_to_find, ()))
+        return found
+
+    def coordinates_of_type(self, type_to_find):
+        return sorted(self._coordinates_of_type(type_to_find), key=lambda coordinates: (coordinates[1], coordinates[0]))
+
+    def _element_index_errors(self, x, y, element):
+        error_list = []
+
+        if not self.indexed(element):
+            error_str = "Object {0} at x:{1} y:{2} is missing from the type index".format(str(element), x, y)
+            error_list.append(Violation("index", error_str, x, y))
+        elif self.locate(element) != (x, y):
+            error_str = "Object {0} at x:{1} y:{2} is registered at {3}".format(str(element), x, y,
+                                                                             self.locate(element))
+            error_list.append(Violation("index", error_str, x, y))
+        for substance_type in element.substance_types():
+            if element not in self.holders.get(substance_type, ()):
+                error_str = "Object {0} at x:{1} y:{2} is missing from the {3} holders".format(
+                    str(element), element.x, element.y, substance_type.__name__)
+                error_list.append(Violation("index", error_str, x, y))
+
+        return error_list
+
+    def _index_count_errors(self, number_stored):
+        number_indexed = sum(len(entities_of_type) for entities_of_type in self.by_type.itervalues())
+
+        if number_indexed != number_stored:
+            error_str = "Type index holds {0} objects, the field holds {1}".format(number_indexed, number_stored)
+            return [Violation("index", error_str)]
+
+        return []
+
+    def _population_errors(self, elements, substance_totals=None):
+        error_list = []
+
+        living = set()
+        dead = set()
+        totals = dict(substance_totals or {})
+        for element in elements:
+            if element.alive:
+                living.add(element)
+            elif element.time_of_death is not None:
+                dead.add(element)
+            for substance_type in element.substance_types():
+                totals[substance_type] = totals.get(substance_type, 0) + element.count_substance_of_type(substance_type)
+
+        if living != self.living or dead != self.dead:
+            error_str = "Population counters hold {0} alive and {1} dead, the field has {2} and {3}".format(
+                len(self.living), len(self.dead), len(living), len(dead))
+            error_list.append(Violation("population", error_str))
+
+        kept = dict((substance_type, number) for substance_type, number in self.substance_totals.iteritems() if number)
+        found = dict((substance_type, number) for substance_type, number in totals.iteritems() if number)
+        if kept != found:
+            error_str = "Substance totals {0} disagree with the field {1}".format(
+                sorted((substance_type.__name__, number) for substance_type, number in kept.iteritems()),
+                sorted((substance_type.__name__, number) for substance_type, number in found.iteritems()))
+            error_list.append(Violation("population", error_str))
+
+        return error_list
+
+    def _passability_errors(self):
+        error_list = []
+
+        if self.passable_flat != bytearray(self.passable.astype(np.uint8).tobytes()):
+            error_list.append(Violation("passability", "Flat passability mirror disagrees with the passability bitmap"))
+
+        wrong_masks = np.count_nonzero(self.free_neighbours != neighbour_masks(self.passable))
+        if wrong_masks:
+            error_str = "Neighbour masks of {0} cells disagree with the passability bitmap".format(wrong_masks)
+            error_list.append(Violation("passability", error_str))
+
+        return error_list
+
+    def _cell_passability_errors(self, x, y):
+        """Passability mirror of the cell and neighbour masks of the cell and the cells around it"""
+        error_list = []
+
+        if self.passable_flat[y * self.length + x] != (1 if self.passable[y, x] else 0):
+            error_str = "Flat passability mirror is stale at coordinates x:{0} y:{1}".format(x, y)
+            error_list.append(Violation("passability", error_str, x, y))
+
+        for cx, cy in [(x, y)] + [(x + dx, y + dy) for dx, dy in NEIGHBOUR_OFFSETS]:
+            if not (0 <= cx < self.length and 0 <= cy < self.height):
+                continue
+            mask = 0
+            for bit, (dx, dy) in enumerate(NEIGHBOUR_OFFSETS):
+                nx, ny = cx + dx, cy + dy
+                if 0 <= nx < self.length and 0 <= ny < self.height and self.passable[ny, nx]:
+                    mask |= 1 << bit
+            if self.free_neighbours[cy, cx] != mask:
+                error_str = "Neighbour mask is stale at coordinates x:{0} y:{1}".format(cx, cy)
+                error_list.append(Violation("passability", error_str, cx, cy))
+
+        return error_list
+
+    def prepare_clone(self, board, memo):
+        pass
+
+    _entity_tables = ("by_type", "holders", "locations", "living", "dead", "held")
+
+    def __deepcopy__(self, memo):
+        """Rebuilds the entity tables in bulk instead of walking them with deepcopy"""
+        twin = self.__class__.__new__(self.__class__)
+        memo[id(self)] = twin
+
+        for name, value in self.__dict__.iteritems():
+            if name not in self._entity_tables:
+                setattr(twin, name, copy.deepcopy(value, memo))
+
+        def twin_of(entity_object):
+            found = memo.get(id(entity_object))
+            if found is None:
+                found = copy.deepcopy(entity_object, memo)
+            return found
+
+        self._copy_entity_tables(twin, twin_of)
+        return twin
+
+    def _copy_entity_tables(self, twin, twin_of):
+        twin.by_type = dict((entity_type, dict((twin_of(entity_object), serial)
+                                               for entity_object, serial in entities_of_type.iteritems()))
+                            for entity_type, entities_of_type in self.by_type.iteritems())
+        twin.holders = dict((substance_type, set(twin_of(entity_object) for entity_object in holders))
+                            for substance_type, holders in self.holders.iteritems())
+        twin.locations = dict((twin_of(entity_object), coordinates)
+                              for entity_object, coordinates in self.locations.iteritems())
+        twin.living = set(twin_of(entity_object) for entity_object in self.living)
+        twin.dead = set(twin_of(entity_object) for entity_object in self.dead)
+        twin.held = dict((twin_of(entity_object), dict(counts)) for entity_object, counts in self.held.iteritems())
+
+
+class ObjectStorage(GridStorage):
+    """Every cell is a list of full entity objects, scenery included"""
+
+    _entity_tables = GridStorage._entity_tables + ("cells",)
+
+    def __init__(self, board, length, height):
+        self.length = length
+        self.height = height
+        self.cells = []
+        self._init_index()
+
+        for y in range(height):
+            row = []
+            self.cells.append(row)
+            for x in range(length):
+                if y == 0 or x == 0 or y == (height - 1) or x == (length - 1):
+                    init_object = entities.Block()
+                else:
+                    init_object = entities.Blank()
+
+                init_object.board = board
+                init_object.x = x
+                init_object.y = y
+                init_object.z = 0
+
+                row.append([init_object])
+                self._index(init_object, x, y)
+
+        self._init_passability(np.array([[cell[-1].passable for cell in row] for row in self.cells], dtype=bool))
+
+    def as_lists(self):
+        return self.cells
+
+    def get_cell(self, x, y):
+        return self.cells[y][x]
+
+    def top(self, x, y):
+        return self.cells[y][x][-1]
+
+    def insert(self, x, y, entity_object):
+        cell = self.cells[y][x]
+
+        if cell[-1].scenery:
+            cell.append(entity_object)
+        else:
+            self._unindex(cell[-1])
+            cell[-1] = entity_object
+
+        self._index(entity_object, x, y)
+        self.__update_top(x, y)
+
+    def remove(self, entity_object, x, y):
+        self.cells[y][x].remove(entity_object)
+        self._unindex(entity_object)
+        self.__update_top(x, y)
+
+    def __update_top(self, x, y):
+        cell = self.cells[y][x]
+        self._set_passable(x, y, len(cell) > 0 and cell[-1].passable)
+
+    def step_scenery(self, epoch):
+        pass
+
+    def prepare_clone(self, board, memo):
+        """Fills a deepcopy memo with copies of the plain Blank and Block objects
+
+        Scenery without states, contents or actions only holds immutable
+        values besides its board, so a copy of its __dict__ is a full copy,
+        and far cheaper than going through deepcopy for every cell.
+        """
+        for row in self.cells:
+            for cell in row:
+                for element in cell:
+                    if type(element) not in (entities.Blank, entities.Block):
+                        continue
+                    if element.action_queue or element.action_log or element._container or element._states_list:
+                        continue
+
+                    twin = object.__new__(element.__class__)
+                    twin.__dict__ = dict(element.__dict__, board=board, action_queue=[], action_log=[],
+                                         _container=[], _states_list=[])
+                    memo[id(element)] = twin
+
+    def _copy_entity_tables(self, twin, twin_of):
+        twin.cells = [[[twin_of(element) for element in cell] for cell in row] for row in self.cells]
+        super(ObjectStorage, self)._copy_entity_tables(twin, twin_of)
+
+    def stacked_elements(self):
+        """Elements above the bottom scenery of their cells, row-major and bottom to top"""
+        found = []
+        for entity_type, entities_of_type in self.by_type.iteritems():
+            if entity_type is entities.Blank:
+                continue
+            for entity_object in entities_of_type:
+                cell = self.cells[entity_object.y][entity_object.x]
+                if cell[0] is not entity_object:
+                    found.append((entity_object.y, entity_object.x, cell.index(entity_object), entity_object))
+        found.sort(key=lambda item: item[:3])
+        return [item[3] for item in found]
+
+    def iter_live_elements(self, epoch):
+        for row in self.cells:
+            for cell in row:
+                for element in cell:
+                    if element.z == epoch:
+                        yield element
+
+    def count_classes(self):
+        return self._count_indexed({})
+
+    def __cell_contents_errors(self, x, y, cell, epoch, on_time):
+        error_list = []
+
+        if len(cell) == 0:
+            error_str = "Absolute vacuum (empty list) at coordinates x:{0} y:{1}".format(x, y)
+            error_list.append(Violation("vacuum", error_str, x, y))
+        elif cell[-1].passable != self.passable[y, x]:
+            error_str = "Passability bitmap is stale at coordinates x:{0} y:{1}".format(x, y)
+            error_list.append(Violation("passability", error_str, x, y))
+        error_list.extend(element_errors(cell, x, y, epoch, on_time))
+        for element in cell:
+            error_list.extend(self._element_index_errors(x, y, element))
+
+        return error_list
+
+    def cell_errors(self, x, y, epoch, on_time=None):
+        error_list = self.__cell_contents_errors(x, y, self.cells[y][x], epoch, on_time)
+        error_list.extend(self._cell_passability_errors(x, y))
+        return error_list
+
+    def integrity_errors(self, epoch, on_time=None):
+        error_list = []
+
+        if len(self.cells) != self.height:
+            error_str = "Field height ({0}) is not equal to the number of rows({1})".format(self.height,
+                                                                                            len(self.cells))
+            error_list.append(Violation("shape", error_str))
+
+        number_stored = 0
+        for y, row in enumerate(self.cells):
+            if len(row) != self.length:
+                error_str = "Field length ({0}) is not equal to the number of cells ({1}) in row {2}".format(
+                    self.length, len(row), y)
+                error_list.append(Violation("shape", error_str))
+            for x, cell in enumerate(row):
+                number_stored += len(cell)
+                error_list.extend(self.__cell_contents_errors(x, y, cell, epoch, on_time))
+
+        error_list.extend(self._index_count_errors(number_stored))
+        error_list.extend(self._population_errors(element for row in self.cells for cell in row for element in cell))
+        error_list.extend(self._passability_errors())
+
+        return error_list
+
+
+class LayerStorage(GridStorage):
+    """Scenery lives in dense NumPy layers, only inserted entities are objects
+
+    The initial Blank/Block grid is never materialized. It is kept as a base
+    type code per cell, while `passable` and `type_code` always describe the
+    top entity of the cell and `substance` counts substances.Substance lying
+    on the base scenery. Inserted entities are stacked above the base in a
+    sparse {(x, y): [entities]} dict. get_cell() wraps the base in a short-lived
+    BlankView/BlockView so callers see the usual list of entities.
+    """
+
+    def __init__(self, board, length, height):
+        self.board = board
+        self.length = length
+        self.height = height
+
+        self.types = []
+        self.type_codes = {}
+
+        self.blank_code = self.code_of(entities.Blank)
+        self.block_code = self.code_of(entities.Block)
+
+        self.base = np.full((height, length), self.block_code, dtype=np.uint8)
+        self.base[1:-1, 1:-1] = self.blank_code
+        self.blank_cells = np.flatnonzero(self.base == self.blank_code)
+        self.base_counts = dict((code, number) for code, number in
+                                enumerate(np.bincount(self.base.ravel()).tolist()) if number > 0)
+
+        self.type_code = self.base.copy()
+        self._init_passability(self.base == self.blank_code)
+        self.substance = np.zeros((height, length), dtype=np.int32)
+        self.substance_cells = set()
+
+        self.stacks = {}
+        self._init_index()
+        self.substance_totals[substances.Substance] = 0
+
+    def code_of(self, entity_type):
+        if entity_type not in self.type_codes:
+            if len(self.types) > np.iinfo(np.uint8).max:
+                raise ValueError("Too many entity types for the type code layer")
+            self.type_codes[entity_type] = len(self.types)
+            self.types.append(entity_type)
+        return self.type_codes[entity_type]
+
+    def base_view(self, x, y):
+        if self.base[y, x] == self.blank_code:
+            return BlankView(self, x, y)
+        return BlockView(self, x, y)
+
+    def as_lists(self):
+        return [[self.get_cell(x, y) for x in range(self.length)] for y in range(self.height)]
+
+    def get_cell(self, x, y):
+        cell = [self.base_view(x, y)]
+        if (x, y) in self.stacks:
+            cell.extend(self.stacks[(x, y)])
+        return cell
+
+    def top(self, x, y):
+        stack = self.stacks.get((x, y))
+        if stack:
+            return stack[-1]
+        return self.base_view(x, y)
+
+    def insert(self, x, y, entity_object):
+        stack = self.stacks.setdefault((x, y), [])
+
+        if not stack or stack[-1].scenery:
+            stack.append(entity_object)
+        else:
+            self._unindex(stack[-1])
+            stack[-1] = entity_object
+
+        self._index(entity_object, x, y)
+        self.__update_top(x, y)
+
+    def remove(self, entity_object, x, y):
+        stack = self.stacks.get((x, y))
+        if stack is None:
+            raise ValueError("{0} is not at x:{1} y:{2}".format(entity_object.class_name(), x, y))
+
+        stack.remove(entity_object)
+        self._unindex(entity_object)
+        if not stack:
+            del self.stacks[(x, y)]
+
+        self.__update_top(x, y)
+
+    def __update_top(self, x, y):
+        stack = self.stacks.get((x, y))
+        if stack:
+            self.type_code[y, x] = self.code_of(type(stack[-1]))
+            self._set_passable(x, y, stack[-1].passable)
+        else:
+            self.type_code[y, x] = self.base[y, x]
+            self._set_passable(x, y, self.base[y, x] == self.blank_code)
+
+    def add_substance(self, x, y, number):
+        self.substance[y, x] += number
+        self.substance_totals[substances.Substance] += number
+        if self.touched is not None:
+            self.touched.add((x, y))
+
+        if self.substance[y, x] > 0:
+            self.substance_cells.add((x, y))
+        else:
+            self.substance_cells.discard((x, y))
+
+    def step_scenery(self, epoch):
+        spawned = self.blank_cells[bernoulli_successes(len(self.blank_cells), entities.Blank.substance_probability)]
+        if len(spawned) == 0:
+            return
+
+        self.substance.ravel()[spawned] += 1
+        self.substance_totals[substances.Substance] += len(spawned)
+
+        ys, xs = np.divmod(spawned, self.length)
+        self.substance_cells.update(zip(xs.tolist(), ys.tolist()))
+        if self.touched is not None:
+            self.touched.update(zip(xs.tolist(), ys.tolist()))
+
+    def __base_codes_of_type(self, type_to_find):
+        return [code for code in (self.blank_code, self.block_code) if issubclass(self.types[code], type_to_find)]
+
+    def entities_of_type(self, type_to_find):
+        found = self._indexed_of_type(type_to_find)
+
+        for code in self.__base_codes_of_type(type_to_find):
+            ys, xs = np.nonzero(self.base == code)
+            found.extend((self.base_view(x, y), 0) for y, x in zip(ys.tolist(), xs.tolist()))
+
+        found.sort(key=lambda item: (item[0].y, item[0].x, item[1]))
+        return [entity_object for entity_object, serial in found]
+
+    def _coordinates_of_type(self, type_to_find):
+        found = super(LayerStorage, self)._coordinates_of_type(type_to_find)
+
+        if type_to_find == substances.Substance:
+            found.update(self.substance_cells)
+
+        for code in self.__base_codes_of_type(type_to_find):
+            ys, xs = np.nonzero(self.base == code)
+            found.update(zip(xs.tolist(), ys.tolist()))
+
+        return found
+
+    def stacked_elements(self):
+        found = []
+        for coordinates in sorted(self.stacks, key=lambda c: (c[1], c[0])):
+            found.extend(self.stacks[coordinates])
+        return found
+
+    def iter_live_elements(self, epoch):
+        for coordinates in sorted(self.stacks, key=lambda c: (c[1], c[0])):
+            for element in self.stacks.get(coordinates, []):
+                if element.z == epoch:
+                    yield element
+
+    def count_classes(self):
+        stats = {}
+        for code, number in self.base_counts.iteritems():
+            class_name = self.types[code].class_name()
+            stats[class_name] = stats.get(class_name, 0) + number
+        return self._count_indexed(stats)
+
+    def __stack_errors(self, x, y, stack, epoch, on_time):
+        error_list = []
+
+        if len(stack) == 0:
+            error_str = "Empty object stack kept at coordinates x:{0} y:{1}".format(x, y)
+            error_list.append(Violation("vacuum", error_str, x, y))
+            return error_list
+        if self.type_code[y, x] != self.code_of(type(stack[-1])) or self.passable[y, x] != stack[-1].passable:
+            error_str = "Layers at coordinates x:{0} y:{1} do not describe top object {2}".format(x, y,
+                                                                                                str(stack[-1]))
+            error_list.append(Violation("layers", error_str, x, y))
+        error_list.extend(element_errors(stack, x, y, epoch, on_time))
+        for element in stack:
+            error_list.extend(self._element_index_errors(x, y, element))
+
+        return error_list
+
+    def cell_errors(self, x, y, epoch, on_time=None):
+        error_list = []
+
+        stack = self.stacks.get((x, y))
+        if stack is not None:
+            error_list.extend(self.__stack_errors(x, y, stack, epoch, on_time))
+        elif self.type_code[y, x] != self.base[y, x] or self.passable[y, x] != (self.base[y, x] == self.blank_code):
+            error_str = "Layers at coordinates x:{0} y:{1} do not describe the base {2}".format(
+                x, y, self.types[self.base[y, x]].__name__)
+            error_list.append(Violation("layers", error_str, x, y))
+
+        if self.substance[y, x] < 0:
+            error_str = "Negative substance count at coordinates x:{0} y:{1}".format(x, y)
+            error_list.append(Violation("substance", error_str, x, y))
+        if (self.substance[y, x] > 0) != ((x, y) in self.substance_cells):
+            error_str = "Substance cell set is stale at coordinates x:{0} y:{1}".format(x, y)
+            error_list.append(Violation("substance", error_str, x, y))
+
+        error_list.extend(self._cell_passability_errors(x, y))
+
+        return error_list
+
+    def integrity_errors(self, epoch, on_time=None):
+        error_list = []
+
+        for name in ("base", "type_code", "passable", "substance"):
+            layer = getattr(self, name)
+            if layer.shape != (self.height, self.length):
+                error_str = "Layer {0} has shape {1}, field is {2}x{3}".format(name, layer.shape, self.length,
+                                                                             self.height)
+                error_list.append(Violation("shape", error_str))
+
+        number_stored = 0
+        for (x, y), stack in sorted(self.stacks.items()):
+            number_stored += len(stack)
+            error_list.extend(self.__stack_errors(x, y, stack, epoch, on_time))
+
+        error_list.extend(self._index_count_errors(number_stored))
+        error_list.extend(self._population_errors((element for stack in self.stacks.itervalues() for element in stack),
+                                                  {substances.Substance: int(self.substance.sum())}))
+
+        if set(zip(*np.nonzero(self.substance > 0)[::-1])) != self.substance_cells:
+            error_list.append(Violation("substance", "Substance cell set disagrees with the substance layer"))
+
+        if (self.substance < 0).any():
+            error_str = "Negative substance count in {0} cells".format(int((self.substance < 0).sum()))
+            error_list.append(Violation("substance", error_str))
+
+        error_list.extend(self._passability_errors())
+
+        return error_list
+
+
+class BlankView(entities.Blank):
+    """Blank of a LayerStorage cell, its container is the substance layer"""
+
+    def __init__(self, layers, x, y):
+        super(BlankView, self).__init__()
+        self.layers = layers
+        self.board = layers.board
+        self.x = x
+        self.y = y
+        self.z = layers.board.epoch
+        self.update_color()
+
+    def live(self):
+        pass
+
+    def contains(self, substance_type):
+        return substance_type == substances.Substance and self.layers.substance[self.y, self.x] > 0
+
+    def extract(self, substance_type):
+        if not self.contains(substance_type):
+            return None
+        self.layers.add_substance(self.x, self.y, -1)
+        self.update_color()
+        return substances.Substance()
+
+    def pocket(self, substance_object):
+        if substance_object is None:
+            return
+        if type(substance_object) != substances.Substance:
+            raise TypeError("Layer storage only keeps substances.Substance on blank cells")
+        self.layers.add_substance(self.x, self.y, 1)
+        self.update_color()
+
+    def count_substance_of_type(self, type_of_substance):
+        if issubclass(substances.Substance, type_of_substance):
+            return int(self.layers.substance[self.y, self.x])
+        return 0
+
+    def substance_types(self):
+        if self.layers.substance[self.y, self.x] > 0:
+            return {substances.Substance}
+        return set()
+
+    def update_color(self):
+        if self.layers.substance[self.y, self.x] > 0:
+            self.color = self.color_full
+        else:
+            self.color = self.color_empty
+
+
+class BlockView(entities.Block):
+    """Block of a LayerStorage cell"""
+
+    def __init__(self, layers, x, y):
+        super(BlockView, self).__init__()
+        self.board = layers.board
+        self.x = x
+        self.y = y
+        self.z = layers.board.epoch
+
+    def live(self):
+        pass
+
+
+def element_errors(cell, x, y, epoch, on_time=None):
+    error_list = []
+
+    if on_time is None:
+        on_time = lambda element: element.z == epoch
+
+    for element in cell:
+        if element.x != x or element.y != y:
+            error_str = "Object at coordinates x:{0} y:{1} thinks it's at x:{2} y:{3}".format(x, y,
+                                                                                              element.x,
+                                                                                              element.y)
+            error_list.append(Violation("position", error_str, x, y))
+        if not on_time(element):
+            error_str = "Object {0} at spacial coordinates x:{1} y:{2} travels in time. Global " \
+                        "epoch: {3}, its local time: {4}".format(str(element), x, y, epoch, element.z)
+            error_list.append(Violation("time", error_str, x, y))
+
+    return error_list
+
+
+STORAGE_ENGINES = {"objects": ObjectStorage,
+                   "layers": LayerStorage}
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import threading
+import Queue
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ModelTrainer(object):
+    """Fits decision models on a worker thread and publishes them by swapping an attribute
+
+    Agents submit labelled batches instead of fitting the shared model in
+    their own live(). The worker takes every batch waiting in the queue,
+    fits them in order on a copy of the published model and then replaces
+    owner.<attribute> with the copy in a single assignment. Until then
+    readers keep predicting with the model published before.
+
+    Batches still in the queue are not copied along with the trainer:
+    call flush() before pickling or deep-copying a field that uses one.
+
+    A synchronous trainer fits and publishes in submit() instead, so results
+    do not depend on thread timing. With random_state set, it is passed to
+    the models being fitted that take one. close() stops the worker thread.
+    """
+
+    def __init__(self, owner, attribute="public_decision_model", synchronous=False, random_state=None):
+        self.owner = owner
+        self.attribute = attribute
+        self.synchronous = synchronous
+        self.random_state = random_state
+
+        self.published = 0
+        self.failed = 0
+
+        self.__queue = None
+        self.__thread = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_ModelTrainer__queue"] = None
+        state["_ModelTrainer__thread"] = None
+        return state
+
+    @property
+    def model(self):
+        return getattr(self.owner, self.attribute)
+
+    def submit(self, X, y, mode="fit", classes=None):
+        if mode not in ("fit", "partial_fit"):
+            raise ValueError("Unknown training mode: {0}".format(mode))
+
+        batch = (np.array(X), np.array(y), mode, classes)
+
+        if self.synchronous:
+            self.flush()
+            self.__fit([batch])
+            return
+
+        if self.__queue is None:
+            self.__queue = Queue.Queue()
+            self.__thread = threading.Thread(target=self.__work, args=(self.__queue,))
+            self.__thread.daemon = True
+            self.__thread.start()
+
+        self.__queue.put(batch)
+
+    def flush(self):
+        """Waits until every submitted batch is fitted and published"""
+        if self.__queue is not None:
+            self.__queue.join()
+
+    def close(self):
+        """Lets the worker thread finish the submitted batches and exit"""
+        if self.__queue is not None:
+            self.__queue.put(None)
+            self.__queue = None
+
+    def join(self, timeout=None):
+        """Waits for a closed trainer's worker thread to exit"""
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            if not self.__thread.is_alive():
+                self.__thread = None
+
+    def __work(self, queue):
+        while True:
+            batches = [queue.get()]
+            while batches[-1] is not None:
+                try:
+                    batches.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            try:
+                self.__fit([batch for batch in batches if batch is not None])
+            finally:
+                for _ in batches:
+                    queue.task_done()
+
+            if batches[-1] is None:
+                return
+
+    def __fit(self, batches):
+        if not batches:
+            return
+
+        model = copy.deepcopy(self.model)
+        if self.random_state is not None and "random_state" in model.get_params():
+            model.set_params(random_state=self.random_state)
+
+        try:
+            for X, y, mode, classes in batches:
+                if mode == "partial_fit":
+                    model.partial_fit(X, y, classes=None if classes is None else np.asarray(classes))
+                else:
+                    model.fit(X, y)
+        except Exception:
+            self.failed += 1
+            logger.exception("Training failed, keeping the published model")
+            return
+
+        setattr(self.owner, self.attribute, model)
+        self.published += 1
+        logger.debug("Published model %d after %d batches", self.published, len(batches))
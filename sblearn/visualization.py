@@ -3,9 +3,14 @@
 import pygame
 from pygame import *
 
+import numpy as np
+
 import tkinter as tk
 import tkFileDialog
 
+import recording
+from integrity import INTEGRITY_LEVELS
+
 # Объявляем переменные
 WIN_WIDTH = 800  # Ширина создаваемого окна
 WIN_HEIGHT = 400  # Высота
@@ -13,9 +18,77 @@ DISPLAY = (WIN_WIDTH, WIN_HEIGHT)  # Группируем ширину и выс
 BACKGROUND_COLOR = "#004400"
 PLATFORM_WIDTH = 10
 PLATFORM_HEIGHT = 10
-
-
-def visualize(field):
+TEXT_AREA = Rect(630, 0, WIN_WIDTH - 630, WIN_HEIGHT)
+FULL_REDRAW_SHARE = 0.25  # при большей доле изменившихся клеток перерисовываем поле целиком
+
+
+class GridRenderer(object):
+    """Draws a grid of palette indices, redrawing only the cells that changed since the last draw
+
+    Colour strings are parsed once, when they get a palette index. A full
+    redraw maps the whole grid through the palette into a pixel array and
+    blits it with pygame.surfarray; otherwise the changed cells are filled
+    one by one. draw() returns the rectangles to pass to display.update().
+    """
+
+    def __init__(self, palette=()):
+        self.palette = []
+        self.__palette_index = {}
+        self.__colors = np.zeros((256, 3), dtype=np.uint8)
+        self.__codes = None
+        for color in palette:
+            self.code_of(color)
+
+    def code_of(self, color):
+        if color not in self.__palette_index:
+            if len(self.palette) >= len(self.__colors):
+                raise ValueError("More than 256 colours on one screen")
+            self.__palette_index[color] = len(self.palette)
+            self.__colors[len(self.palette)] = tuple(Color(color))[:3]
+            self.palette.append(color)
+        return self.__palette_index[color]
+
+    def reset(self):
+        """Makes the next draw() redraw every cell"""
+        self.__codes = None
+
+    def field_codes(self, field):
+        codes = np.empty((field.height, field.length), dtype=np.uint8)
+        recording.render_frame(field, codes, self.code_of)
+        return codes
+
+    def draw(self, screen, codes):
+        height, length = codes.shape
+
+        if self.__codes is not None and self.__codes.shape == codes.shape:
+            changed = np.argwhere(codes != self.__codes)
+            if len(changed) <= FULL_REDRAW_SHARE * codes.size:
+                rects = []
+                for y, x in changed:
+                    rect = Rect(x * PLATFORM_WIDTH, y * PLATFORM_HEIGHT, PLATFORM_WIDTH, PLATFORM_HEIGHT)
+                    screen.fill(self.__colors[codes[y, x]], rect)
+                    rects.append(rect)
+                self.__codes = codes.copy()
+                return rects
+
+        pixels = self.__colors[codes]
+        pixels = pixels.repeat(PLATFORM_HEIGHT, axis=0).repeat(PLATFORM_WIDTH, axis=1).transpose(1, 0, 2)
+        grid = Surface((length * PLATFORM_WIDTH, height * PLATFORM_HEIGHT))
+        pygame.surfarray.blit_array(grid, pixels)
+        self.__codes = codes.copy()
+        return [screen.blit(grid, (0, 0))]
+
+
+def draw_text(screen, bg, myfont, lines):
+    """Redraws the text area with the given lines, returns its rectangle"""
+    screen.blit(bg, TEXT_AREA, TEXT_AREA)
+    for i, line in enumerate(lines):
+        label = myfont.render(line, 1, (255, 255, 0))
+        screen.blit(label, (TEXT_AREA.x, 10 + (i * 15)))
+    return TEXT_AREA
+
+
+def visualize(field, integrity="sampled"):
     pygame.init()  # Инициация PyGame, обязательная строчка
     screen = pygame.display.set_mode(DISPLAY)  # Создаем окошко
     pygame.display.set_caption("Field game")  # Пишем в шапку
@@ -30,9 +103,15 @@ def visualize(field):
 
     # <editor-fold desc="Field">
     f = field
+    f.set_integrity_level(integrity)
     tick = 10
+    renderer = GridRenderer()
+    codes = None
     # </editor-fold>
 
+    screen.blit(bg, (0, 0))
+    pygame.display.flip()
+
     timer = pygame.time.Clock()
     go_on = True
 
@@ -54,7 +133,15 @@ def visualize(field):
                     root.withdraw()
                     file_path = tkFileDialog.askopenfilename()
                     f = field.load_from_pickle(file_path)
+                    f.set_integrity_level(integrity)
                     f.pause = True
+                    screen.blit(bg, (0, 0))
+                    pygame.display.flip()
+                    renderer.reset()
+                    codes = None
+                elif e.key == pygame.K_i:
+                    level = INTEGRITY_LEVELS.index(f.integrity_level)
+                    f.set_integrity_level(INTEGRITY_LEVELS[(level + 1) % len(INTEGRITY_LEVELS)])
                 elif e.key == pygame.K_UP:
                     tick += 10
                 elif e.key == pygame.K_DOWN and tick >= 11:
@@ -62,38 +149,96 @@ def visualize(field):
                 elif e.key == pygame.K_ESCAPE:
                     go_on = False
 
-        screen.blit(bg, (0, 0))  # Каждую итерацию необходимо всё перерисовывать
-
         # <editor-fold desc="Field">  TODO Нет первого состояния!
         # if f.epoch == 1000:
         #     f.pause = True
-        f.integrity_check()
+        report = f.integrity_check()
         f.make_time()
-        level = f.list_obj_representation()
+        if codes is None or not f.pause:
+            codes = renderer.field_codes(f)
         # </editor-fold>
 
         # <editor-fold desc="Text stats">
-        # render text
-        label = myfont.render("Epoch: {0}".format(f.epoch), 1, (255, 255, 0))
-        screen.blit(label, (630, 10))
-
         stats = f.get_stats()
-        for i, element in enumerate(stats):
-            label = myfont.render("{0}: {1}".format(element, stats[element]), 1, (255, 255, 0))
-            screen.blit(label, (630, 25 + (i * 15)))
-
+        lines = ["Epoch: {0}".format(f.epoch),
+                 "Integrity: {0} ({1})".format(report.level, len(report))]
+        lines.extend("{0}: {1}".format(element, stats[element]) for element in stats)
+        rects = [draw_text(screen, bg, myfont, lines)]
         # </editor-fold>
 
-        x = y = 0  # координаты
+        rects.extend(renderer.draw(screen, codes))
+
+        pygame.display.update(rects)  # выводим на экран только изменившиеся области
+
+
+def playback(filename):
+    """Shows a recording made by recording.FrameRecorder
+
+    Space pauses, left/right change the playback speed in frames per tick
+    (negative plays backwards), up/down change the tick rate, pageup/pagedown
+    jump 100 frames, home/end go to the first/last frame.
+    """
+    frames = recording.FrameFile(filename)
+    if not len(frames):
+        raise ValueError("{0} has no frames".format(filename))
+    renderer = GridRenderer(frames.palette)
+
+    pygame.init()
+    screen = pygame.display.set_mode(DISPLAY)
+    pygame.display.set_caption("Field game playback")
+    bg = Surface((WIN_WIDTH, WIN_HEIGHT))
+    bg.fill(Color(BACKGROUND_COLOR))
+
+    myfont = pygame.font.SysFont("monospace", 15)
+
+    screen.blit(bg, (0, 0))
+    pygame.display.flip()
+
+    tick = 10
+    speed = 1
+    pause = False
+    position = 0
+    last = len(frames) - 1
+
+    timer = pygame.time.Clock()
+    go_on = True
+
+    while go_on:
+        timer.tick(tick)
+        for e in pygame.event.get():
+            if e.type == QUIT:
+                raise SystemExit, "QUIT"
+            if e.type == pygame.KEYDOWN:
+                if e.key == pygame.K_SPACE:
+                    pause = not pause
+                elif e.key == pygame.K_RIGHT:
+                    speed += 1
+                elif e.key == pygame.K_LEFT:
+                    speed -= 1
+                elif e.key == pygame.K_PAGEUP:
+                    position = min(position + 100, last)
+                elif e.key == pygame.K_PAGEDOWN:
+                    position = max(position - 100, 0)
+                elif e.key == pygame.K_HOME:
+                    position = 0
+                elif e.key == pygame.K_END:
+                    position = last
+                elif e.key == pygame.K_UP:
+                    tick += 10
+                elif e.key == pygame.K_DOWN and tick >= 11:
+                    tick -= 10
+                elif e.key == pygame.K_ESCAPE:
+                    go_on = False
+
+        stats = frames.stats[position]
+        lines = ["Epoch: {0}".format(frames.epochs[position]),
+                 "Frame: {0}/{1} x{2}".format(position + 1, len(frames), speed)]
+        lines.extend("{0}: {1}".format(element, stats[element]) for element in stats)
+        rects = [draw_text(screen, bg, myfont, lines)]
 
-        for row in level:  # вся строка
-            for element in row:  # каждый символ
-                pf = Surface((PLATFORM_WIDTH, PLATFORM_HEIGHT))
-                pf.fill(Color(element.color))
-                screen.blit(pf, (x, y))
+        rects.extend(renderer.draw(screen, frames.frame(position)))
 
-                x += PLATFORM_WIDTH  # блоки платформы ставятся на ширине блоков
-            y += PLATFORM_HEIGHT  # то же самое и с высотой
-            x = 0  # на каждой новой строчке начинаем с нуля
+        pygame.display.update(rects)
 
-        pygame.display.update()  # обновление и вывод всех изменений на экран
+        if not pause:
+            position = min(max(position + speed, 0), last)